@@ -0,0 +1,229 @@
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from grader import grade_assignment, grade_batch, grading_cache_key, load_rubric
+from grading_cache import grading_cache
+from job_queue import GRADER_WORKERS
+from llm_client import estimate_tokens
+from metrics import registry
+from rubric_registry import DEFAULT_RUBRIC
+
+logger = logging.getLogger(__name__)
+
+# Pack short submissions that share a rubric into one model call
+BATCH_GRADING = os.getenv("BATCH_GRADING", "false").lower() == "true"
+# Capped at GRADER_WORKERS: each waiting submission holds a grading worker, so a larger batch could never fill
+BATCH_MAX_SIZE = min(int(os.getenv("BATCH_MAX_SIZE", "8")), GRADER_WORKERS)
+# Seconds the first submission of a batch waits for others to join it
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", "3"))
+# Estimated prompt tokens of all submissions in one batch
+BATCH_TOKEN_BUDGET = int(os.getenv("BATCH_TOKEN_BUDGET", "12000"))
+# Submissions estimated above this are always graded on their own
+BATCH_MAX_SUBMISSION_TOKENS = int(os.getenv("BATCH_MAX_SUBMISSION_TOKENS", "2000"))
+
+TOKENS_SAVED = registry.counter("grader_prompt_tokens_saved_total", "Estimated prompt tokens removed by preprocessing")
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+OUT_OF = re.compile(r"/\s*(\d+(?:\.\d+)?)")
+
+
+class _Submission:
+    def __init__(self, submission_id, text, tokens):
+        self.id = submission_id
+        self.text = text
+        self.tokens = tokens
+        self.result = None
+        self.done = threading.Event()
+
+
+class _Batch:
+    def __init__(self):
+        self.submissions = []
+        self.tokens = 0
+        # Set once the batch goes to the model as one call; a batch of one is just graded alone
+        self.batched = False
+        self.full = threading.Event()
+
+
+class BatchGrader:
+    """Groups concurrent grading calls for the same rubric into shared model requests.
+
+    The first caller to open a batch waits up to `max_wait` seconds for other
+    callers to join, then sends the whole batch; the others block until their
+    result is ready. Anything the batch response doesn't cover is graded with
+    a normal single-submission call by its own caller. Batches can only be as
+    large as the number of concurrent callers, so run at least `max_size`
+    grading workers.
+    """
+
+    def __init__(self, max_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT, token_budget=BATCH_TOKEN_BUDGET,
+                 max_submission_tokens=BATCH_MAX_SUBMISSION_TOKENS):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.token_budget = token_budget
+        self.max_submission_tokens = max_submission_tokens
+        self.batches_sent = 0
+        self.batched_submissions = 0
+        self.fallbacks = 0
+        self._open = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def grade(self, assignment_text, rubric_name=DEFAULT_RUBRIC, force=False):
+        tokens = estimate_tokens(assignment_text)
+        rubric = load_rubric(rubric_name)
+        if force or rubric is None or tokens > self.max_submission_tokens:
+            return grade_assignment(assignment_text, rubric_name, force=force)
+        cached = grading_cache.get(grading_cache_key(assignment_text, rubric))
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            self._next_id += 1
+            submission = _Submission(str(self._next_id), assignment_text, tokens)
+            batch = self._open.get(rubric_name)
+            leader = batch is None or batch.tokens + tokens > self.token_budget
+            if leader:
+                if batch is not None:
+                    # Over the token budget: send the current batch now and start a new one
+                    batch.full.set()
+                batch = _Batch()
+                self._open[rubric_name] = batch
+            batch.submissions.append(submission)
+            batch.tokens += tokens
+            if len(batch.submissions) >= self.max_size:
+                batch.full.set()
+                del self._open[rubric_name]
+
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open.get(rubric_name) is batch:
+                    del self._open[rubric_name]
+            self._send(batch, rubric_name, rubric)
+        else:
+            submission.done.wait()
+
+        if submission.result is None:
+            if batch.batched:
+                # The batched call failed or its response didn't cover this submission
+                self.fallbacks += 1
+            # force: the cache was already checked above, so don't count a second lookup
+            return grade_assignment(assignment_text, rubric_name, force=True)
+        return submission.result
+
+    def _send(self, batch, rubric_name, rubric):
+        submissions = batch.submissions
+        try:
+            if len(submissions) > 1:
+                batch.batched = True
+                results = grade_batch([(s.id, s.text) for s in submissions], rubric_name)
+                self.batches_sent += 1
+                self.batched_submissions += len(results)
+                for s in submissions:
+                    s.result = results.get(s.id)
+                    if s.result is not None:
+                        grading_cache.put(grading_cache_key(s.text, rubric), s.result)
+        finally:
+            for s in submissions:
+                s.done.set()
+
+
+batch_grader = BatchGrader()
+registry.callback("batch_grader_batches_total", "Batched model calls sent", lambda: batch_grader.batches_sent, kind="counter")
+registry.callback(
+    "batch_grader_submissions_total", "Submissions graded in a batch", lambda: batch_grader.batched_submissions, kind="counter"
+)
+registry.callback(
+    "batch_grader_fallbacks_total", "Submissions regraded alone after a batch", lambda: batch_grader.fallbacks, kind="counter"
+)
+
+
+def grade_submission(assignment_text, rubric_name=DEFAULT_RUBRIC, force=False):
+    """Grade one submission, sharing a model call with others when BATCH_GRADING is on."""
+    if BATCH_GRADING:
+        return batch_grader.grade(assignment_text, rubric_name, force=force)
+    return grade_assignment(assignment_text, rubric_name, force=force)
+
+
+def parse_number(value):
+    match = NUMBER.search(str(value or ""))
+    return float(match.group()) if match else None
+
+
+def _weighted_mean(pairs):
+    pairs = [(value, weight) for value, weight in pairs if value is not None]
+    total = sum(weight for _, weight in pairs)
+    if not total:
+        return None
+    return sum(value * weight for value, weight in pairs) / total
+
+
+def merge_chunk_results(results, weights):
+    """Combine per-chunk gradings into one, weighting scores by chunk length."""
+    # A grade missing a part would look complete but be wrong; fail the whole submission instead
+    for part, result in enumerate(results, 1):
+        if "error" in result:
+            return dict(result, error=f"Part {part} of {len(results)} could not be graded: {result['error']}")
+    graded = list(zip(results, weights))
+
+    overall = _weighted_mean((parse_number(r.get("overall_grade")), w) for r, w in graded)
+    names = [r.get("student_name") for r, _ in graded if r.get("student_name") not in (None, "", "Unknown")]
+
+    criteria = {}
+    for part, (result, weight) in enumerate(graded, 1):
+        for score in result.get("criteria_scores", []):
+            entry = criteria.setdefault(
+                score.get("criterion", "N/A"), {"scores": [], "out_of": None, "justification": [], "detalle": []}
+            )
+            out_of = OUT_OF.search(str(score.get("score", "")))
+            if out_of and entry["out_of"] is None:
+                entry["out_of"] = out_of.group(1)
+            entry["scores"].append((parse_number(score.get("score")), weight))
+            if score.get("justification"):
+                entry["justification"].append(f"Part {part}: {score['justification']}")
+            if score.get("detalle"):
+                entry["detalle"].append(f"Part {part}: {score['detalle']}")
+
+    criteria_scores = []
+    for name, entry in criteria.items():
+        mean = _weighted_mean(entry["scores"])
+        if mean is None:
+            score = "N/A"
+        else:
+            score = f"{mean:g}" if mean == int(mean) else f"{mean:.1f}"
+            if entry["out_of"]:
+                score = f"{score}/{entry['out_of']}"
+        criteria_scores.append({
+            "criterion": name,
+            "score": score,
+            "justification": " ".join(entry["justification"]),
+            "detalle": " ".join(entry["detalle"]),
+        })
+
+    return {
+        "student_name": names[0] if names else "Unknown",
+        "overall_grade": "N/A" if overall is None else f"{round(overall)}%",
+        "feedback": "\n\n".join(f"Part {part}: {r.get('feedback', '')}" for part, (r, _) in enumerate(graded, 1)),
+        "criteria_scores": criteria_scores,
+    }
+
+
+def grade_prepared(prepared, rubric_name=DEFAULT_RUBRIC, force=False):
+    """Grade a prepared submission, merging per-chunk results when it was split."""
+    if len(prepared.chunks) == 1:
+        result = grade_submission(prepared.chunks[0], rubric_name, force=force)
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(prepared.chunks), 4)) as executor:
+            results = list(executor.map(lambda chunk: grade_submission(chunk, rubric_name, force=force), prepared.chunks))
+        result = merge_chunk_results(results, [len(chunk) for chunk in prepared.chunks])
+
+    report = prepared.report()
+    TOKENS_SAVED.inc(report["saved_tokens"])
+    logger.info("Prompt size: %d tokens (saved %d, mode %s).", report["prompt_tokens"], report["saved_tokens"],
+                report["mode"], extra=report)
+    if "error" not in result:
+        result["token_report"] = report
+    return result
@@ -0,0 +1,88 @@
+"""Deterministic stand-in for genai.GenerativeModel."""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+CRITERION = re.compile(r"Criteria: (.+) \((\d+(?:\.\d+)?) points\)")
+BATCH_ID = re.compile(r"=== Submission (\S+) ===")
+REPAIR_CRITERION = re.compile(r'- criterion "(.+)": score between 0 and (\d+(?:\.\d+)?) points')
+
+
+class ResourceExhausted(Exception):
+    """Named like the google.api_core error so LLMClient treats it as retryable."""
+
+    code = 429
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Answers grading prompts with valid JSON after a simulated delay.
+
+    Scores are derived from a hash of the prompt, so the same submission
+    always gets the same grade. `failure_rate` of calls raise a retryable
+    quota error instead.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        with self._lock:
+            self.calls += 1
+            delay = max(self.latency + self._rng.uniform(-self.jitter, self.jitter), 0)
+            fail = self._rng.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+        time.sleep(delay)
+        if fail:
+            raise ResourceExhausted("429 Quota exceeded (simulated)")
+
+        seed = int(hashlib.sha256(prompt.encode("utf-8", "replace")).hexdigest()[:8], 16)
+        repair = REPAIR_CRITERION.findall(prompt)
+        if repair:
+            return FakeResponse(json.dumps({"criteria_scores": self._scores(repair, seed)}))
+        criteria = CRITERION.findall(prompt)
+        batch_ids = BATCH_ID.findall(prompt)
+        if batch_ids:
+            return FakeResponse(json.dumps([
+                dict(self._grading(criteria, seed + i), submission_id=submission_id)
+                for i, submission_id in enumerate(batch_ids)
+            ]))
+        return FakeResponse(json.dumps(self._grading(criteria, seed)))
+
+    @staticmethod
+    def _scores(criteria, seed):
+        rng = random.Random(seed)
+        return [
+            {
+                "criterion": title,
+                "score": f"{round(float(points) * rng.uniform(0.5, 1.0))}/{points}",
+                "justification": "Meets most expectations for this criterion.",
+                "detalle": "Some analysis could go deeper.",
+            }
+            for title, points in criteria
+        ]
+
+    def _grading(self, criteria, seed):
+        scores = self._scores(criteria, seed)
+        total = sum(float(points) for _, points in criteria) or 1
+        awarded = sum(float(score["score"].split("/")[0]) for score in scores)
+        return {
+            "student_name": f"Student {seed % 1000}",
+            "overall_grade": f"{round(awarded * 100 / total)}%",
+            "feedback": "A solid submission with room for deeper analysis.",
+            "criteria_scores": scores,
+        }
@@ -0,0 +1,220 @@
+"""Minimal local IMAP and SMTP servers, just enough for the email pipeline."""
+import email
+import re
+import select
+import socketserver
+import threading
+import time
+
+
+def _quote(value):
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _params(pairs):
+    if not pairs:
+        return "NIL"
+    return "(" + " ".join(f"{_quote(key.upper())} {_quote(value)}" for key, value in pairs) + ")"
+
+
+def bodystructure(part):
+    if part.is_multipart():
+        children = "".join(bodystructure(child) for child in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype().upper())} NIL NIL NIL NIL)"
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    params = part.get_params()[1:] if part.get_params() else []
+    encoding = part.get("Content-Transfer-Encoding", "7bit")
+    payload = part.get_payload()
+    disposition = "NIL"
+    if part.get("Content-Disposition"):
+        filename = part.get_param("filename", header="content-disposition")
+        kind = part.get("Content-Disposition").split(";")[0]
+        disposition = f"({_quote(kind.upper())} {_params([('filename', filename)] if filename else [])})"
+    base = f"{_quote(maintype.upper())} {_quote(subtype.upper())} {_params(params)} NIL NIL {_quote(encoding.upper())} {len(payload.encode())}"
+    if maintype == "text":
+        return f"({base} {len(payload.splitlines())} NIL {disposition} NIL NIL)"
+    return f"({base} NIL {disposition} NIL NIL)"
+
+
+def body_part(msg, spec):
+    part = msg
+    for index in spec.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+    return part.get_payload().encode()
+
+
+class Mailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.changed = threading.Condition()
+
+    def add(self, raw):
+        with self.changed:
+            uid = self.next_uid
+            self.messages.append({"uid": uid, "msg": email.message_from_bytes(raw), "seen": False})
+            self.next_uid += 1
+            self.changed.notify_all()
+        return uid
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode())
+        self.wfile.flush()
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        # Message count this client has been told about, as a real server tracks per session
+        self.known = 0
+        self.send("* OK benchmark IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode().rstrip("\r\n").split(" ", 2)
+            tag, command = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ""
+            if command == "CAPABILITY":
+                self.send(f"* CAPABILITY IMAP4rev1 IDLE\r\n{tag} OK done\r\n")
+            elif command in ("LOGIN", "NOOP"):
+                self.send(f"{tag} OK done\r\n")
+            elif command == "SELECT":
+                self.known = len(mailbox.messages)
+                self.send(f"* {len(mailbox.messages)} EXISTS\r\n* OK [UIDVALIDITY {mailbox.uidvalidity}] ok\r\n"
+                          f"{tag} OK [READ-WRITE] done\r\n")
+            elif command == "LOGOUT":
+                self.send(f"* BYE\r\n{tag} OK done\r\n")
+                return
+            elif command == "IDLE":
+                self.idle(tag, mailbox)
+            elif command == "UID":
+                self.uid_command(tag, args, mailbox)
+            else:
+                self.send(f"{tag} BAD unknown command\r\n")
+
+    def idle(self, tag, mailbox):
+        self.send("+ idling\r\n")
+        while True:
+            # Report new mail as it arrives, until the client sends DONE
+            if select.select([self.connection], [], [], 0.05)[0]:
+                self.rfile.readline()
+                self.send(f"{tag} OK idle done\r\n")
+                return
+            with mailbox.changed:
+                count = len(mailbox.messages)
+            if count > self.known:
+                self.known = count
+                self.send(f"* {count} EXISTS\r\n")
+
+    def uid_command(self, tag, args, mailbox):
+        subcommand, rest = args.split(" ", 1)
+        subcommand = subcommand.upper()
+        if subcommand == "SEARCH":
+            match = re.search(r"UID (\d+):\*", rest)
+            with mailbox.changed:
+                self.known = len(mailbox.messages)
+                if match:
+                    low = int(match.group(1))
+                    uids = [m["uid"] for m in mailbox.messages if m["uid"] >= low]
+                    if not uids and mailbox.messages:
+                        uids = [mailbox.messages[-1]["uid"]]
+                else:
+                    uids = [m["uid"] for m in mailbox.messages if not m["seen"]]
+            self.send("* SEARCH " + " ".join(map(str, uids)) + f"\r\n{tag} OK done\r\n")
+        elif subcommand == "FETCH":
+            uid_set, items = rest.split(" ", 1)
+            wanted = {int(uid) for uid in uid_set.split(",")}
+            for sequence, message in enumerate(list(mailbox.messages), 1):
+                if message["uid"] not in wanted:
+                    continue
+                msg = message["msg"]
+                out = [f"UID {message['uid']}".encode()]
+                if "BODYSTRUCTURE" in items:
+                    out.append(("BODYSTRUCTURE " + bodystructure(msg)).encode())
+                if "HEADER.FIELDS" in items:
+                    header = "".join(f"{key}: {msg[key]}\r\n" for key in ("From", "Subject") if msg[key]).encode() + b"\r\n"
+                    out.append(b"BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}\r\n" % len(header) + header)
+                for spec in re.findall(r"BODY\.PEEK\[([\d.]+)\]", items):
+                    data = body_part(msg, spec)
+                    out.append(b"BODY[%s] {%d}\r\n" % (spec.encode(), len(data)) + data)
+                self.send(b"* %d FETCH (" % sequence + b" ".join(out) + b")\r\n")
+            self.send(f"{tag} OK done\r\n")
+        elif subcommand == "STORE":
+            uid = int(rest.split(" ")[0])
+            for message in mailbox.messages:
+                if message["uid"] == uid:
+                    message["seen"] = True
+            self.send(f"{tag} OK done\r\n")
+        else:
+            self.send(f"{tag} BAD unknown UID command\r\n")
+
+
+class IMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox, address=("127.0.0.1", 0)):
+        super().__init__(address, IMAPHandler)
+        self.mailbox = mailbox
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.connections += 1
+        self.send("220 benchmark SMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.wfile.write(b"250-benchmark\r\n250 8BITMIME\r\n")
+                self.wfile.flush()
+            elif command.startswith("DATA"):
+                self.send("354 go ahead")
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b".\r\n", b""):
+                        break
+                    data.append(line)
+                self.server.received(b"".join(data))
+                self.send("250 ok")
+            elif command.startswith("QUIT"):
+                self.send("221 bye")
+                return
+            else:
+                self.send("250 ok")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    """Records every delivered message with the time it arrived."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.arrived = threading.Condition()
+
+    def received(self, data):
+        with self.arrived:
+            self.messages.append((time.perf_counter(), email.message_from_bytes(data)))
+            self.arrived.notify_all()
+
+
+def serve_in_background(server):
+    thread = threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True)
+    thread.start()
+    return server.server_address[1]
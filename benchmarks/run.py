@@ -0,0 +1,391 @@
+"""Offline throughput benchmark for the grading pipeline.
+
+Run from the repository root:
+
+    python -m benchmarks.run --submissions 40 --concurrency 8 --pages 5 --llm-latency 0.5
+
+Everything runs locally in a scratch directory: the app is served by
+uvicorn, the model is a deterministic fake, and the mailbox and outgoing
+mail go to in-process IMAP and SMTP stand-ins. Three scenarios are run in
+turn (uploads through /upload-pdf/ and /jobs/, emailed submissions, and
+/results/ polling), and each reports p50/p95/p99 latency, throughput and
+peak RSS, along with per-stage latencies from the app's own spans.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fake_llm import FakeGenerativeModel
+from benchmarks.mail_server import IMAPServer, Mailbox, SMTPServer, serve_in_background
+from benchmarks.synthetic import make_email, make_pdf
+
+SCENARIOS = ("upload", "email", "results")
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(p / 100.0 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def _proc_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _process_tree(root):
+    """PIDs of `root` and all its descendants (PDF parser processes included)."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; fields after the closing paren are fixed
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(ppid, []).append(int(entry))
+    tree = [root]
+    for pid in tree:
+        tree.extend(parents.get(pid, []))
+    return tree
+
+
+class RSSSampler:
+    """Tracks peak RSS of this process and of the whole process tree while running."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_main_kb = 0
+        self.peak_tree_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        pid = os.getpid()
+        while True:
+            if os.path.isdir("/proc"):
+                self.peak_main_kb = max(self.peak_main_kb, _proc_rss_kb(pid))
+                self.peak_tree_kb = max(self.peak_tree_kb, sum(_proc_rss_kb(p) for p in _process_tree(pid)))
+            else:
+                import resource
+                # ru_maxrss is KiB on Linux but bytes on macOS; close enough for a fallback
+                self.peak_main_kb = self.peak_tree_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if self._stop.wait(self.interval):
+                return
+
+
+class StageRecorder:
+    """Keeps every span duration, tagged with the scenario running at the time."""
+
+    def __init__(self):
+        self.scenario = None
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def install(self, histogram):
+        observe = histogram.observe
+
+        def record(value, **labels):
+            observe(value, **labels)
+            with self._lock:
+                self.samples.setdefault((self.scenario, labels.get("stage")), []).append(value)
+
+        histogram.observe = record
+
+    def for_scenario(self, scenario):
+        return {stage: values for (name, stage), values in self.samples.items() if name == scenario}
+
+
+class Client:
+    """One keep-alive HTTP connection per thread."""
+
+    def __init__(self, port):
+        self.port = port
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def upload(self, filename, data):
+        boundary = uuid.uuid4().hex
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/pdf\r\n\r\n"
+        ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        return self.request("POST", "/upload-pdf/", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure_environment(args, workdir, imap_port, smtp_port):
+    """Point the app at the scratch directory and local stand-ins; must run before it is imported."""
+    shutil.copy(os.path.join(REPO_ROOT, "rubrics.json"), workdir)
+    os.chdir(workdir)
+    os.environ.update({
+        "LOG_LEVEL": args.log_level,
+        "GEMINI_API_KEY": "benchmark",
+        "EMAIL_ADDRESS": "grader@example.com",
+        "EMAIL_PASSWORD": "benchmark",
+        "IMAP_HOST": "127.0.0.1",
+        "IMAP_PORT": str(imap_port),
+        "IMAP_SSL": "false",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_SSL": "false",
+        "SMTP_MAX_PER_MINUTE": "0",
+        "EMAIL_POLL_INTERVAL": "5",
+        "GRADER_WORKERS": str(args.workers),
+        "LLM_REQUESTS_PER_MINUTE": str(args.llm_rpm),
+        "LLM_BACKOFF_BASE": "0.05",
+        "CIRCUIT_FAILURE_THRESHOLD": str(max(args.workers * 4, 5)),
+    })
+
+
+def start_app(port):
+    import uvicorn
+    import main
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, name="uvicorn", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError("App did not start")
+        time.sleep(0.05)
+    return server
+
+
+def run_upload(args, client):
+    def submit(i):
+        pdf = make_pdf(pages=args.pages, words_per_page=args.words_per_page, seed=10_000 + i)
+        start = time.perf_counter()
+        status, _, body = client.upload(f"upload-{i}.pdf", pdf)
+        if status != 202:
+            raise RuntimeError(f"upload returned {status}: {body[:200]!r}")
+        job_id = json.loads(body)["job_id"]
+        while True:
+            status, _, body = client.request("GET", f"/jobs/{job_id}")
+            job = json.loads(body)
+            if job["status"] in ("done", "failed"):
+                if job["status"] == "failed":
+                    raise RuntimeError(job["error"])
+                return time.perf_counter() - start
+            time.sleep(args.poll_interval)
+
+    return _run_concurrently(submit, args.submissions, args.concurrency)
+
+
+def run_email(args, mailbox, smtp):
+    sent_at = {}
+    for i in range(args.submissions):
+        subject = f"Benchmark submission {i}"
+        raw = make_email(f"student{i}@example.com", "grader@example.com", subject,
+                         make_pdf(pages=args.pages, words_per_page=args.words_per_page, seed=20_000 + i))
+        sent_at[subject] = time.perf_counter()
+        mailbox.add(raw)
+
+    latencies = []
+    errors = 0
+    seen = 0
+    deadline = time.monotonic() + args.timeout
+    with smtp.arrived:
+        while len(latencies) + errors < len(sent_at) and time.monotonic() < deadline:
+            smtp.arrived.wait(0.5)
+            for arrived, msg in smtp.messages[seen:]:
+                subject = (msg["Subject"] or "").removeprefix("Re: ")
+                for original, start in sent_at.items():
+                    if subject.startswith(original + " - "):
+                        if "Error" in subject:
+                            errors += 1
+                        else:
+                            latencies.append(arrived - start)
+                        break
+            seen = len(smtp.messages)
+    # Anything without a feedback reply by the deadline counts as failed
+    return latencies, len(sent_at) - len(latencies)
+
+
+def run_results(args, client):
+    def poll(_):
+        start = time.perf_counter()
+        status, headers, _ = client.request("GET", "/results/?limit=100")
+        etag = headers.get("etag") or headers.get("ETag")
+        if status != 200:
+            raise RuntimeError(f"/results/ returned {status}")
+        # A dashboard's follow-up poll: nothing changed, so this should be a 304
+        client.request("GET", "/results/?limit=100", headers={"If-None-Match": etag} if etag else {})
+        return time.perf_counter() - start
+
+    return _run_concurrently(poll, args.results_requests, args.concurrency)
+
+
+def _run_concurrently(func, count, concurrency):
+    latencies = []
+    errors = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(func, i) for i in range(count)]:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors += 1
+                print(f"  request failed: {e}", file=sys.stderr)
+    return latencies, errors
+
+
+def summarize(name, latencies, errors, elapsed, sampler, stages):
+    return {
+        "scenario": name,
+        "completed": len(latencies),
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "per_minute": round(len(latencies) / elapsed * 60, 1) if elapsed else 0.0,
+        "latency": {f"p{p}": round(percentile(latencies, p), 4) for p in (50, 95, 99)},
+        "peak_rss_mb": round(sampler.peak_main_kb / 1024, 1),
+        "peak_tree_rss_mb": round(sampler.peak_tree_kb / 1024, 1),
+        "stages": {
+            stage: {"count": len(values), **{f"p{p}": round(percentile(values, p), 4) for p in (50, 95, 99)}}
+            for stage, values in sorted(stages.items())
+        },
+    }
+
+
+def print_report(report):
+    for entry in report:
+        print(f"\n== {entry['scenario']} ==")
+        latency = entry["latency"]
+        print(f"  completed {entry['completed']}, errors {entry['errors']}, {entry['elapsed_seconds']}s, "
+              f"{entry['per_minute']}/min")
+        print(f"  latency p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s")
+        print(f"  peak RSS {entry['peak_rss_mb']} MB (with child processes {entry['peak_tree_rss_mb']} MB)")
+        if entry["stages"]:
+            print(f"  {'stage':<16}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+            for stage, stats in entry["stages"].items():
+                print(f"  {stage:<16}{stats['count']:>8}{stats['p50']:>10.4f}{stats['p95']:>10.4f}{stats['p99']:>10.4f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--submissions", type=int, default=20, help="submissions per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--workers", type=int, default=4, help="grading workers (GRADER_WORKERS)")
+    parser.add_argument("--pages", type=int, default=3, help="pages per synthetic PDF")
+    parser.add_argument("--words-per-page", type=int, default=250)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="mean fake model latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="share of model calls that fail with a 429")
+    parser.add_argument("--llm-rpm", type=float, default=100000, help="model requests per minute allowed by the client")
+    parser.add_argument("--results-requests", type=int, default=200)
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="seconds between /jobs/ polls")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for emailed replies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    workdir = tempfile.mkdtemp(prefix="grader-bench-")
+    mailbox = Mailbox()
+    imap = IMAPServer(mailbox)
+    smtp = SMTPServer()
+    configure_environment(args, workdir, serve_in_background(imap), serve_in_background(smtp))
+
+    import grader
+    import metrics
+
+    fake_model = FakeGenerativeModel(args.llm_latency, args.llm_jitter, args.llm_failure_rate, args.seed)
+    grader.llm.model = fake_model
+    recorder = StageRecorder()
+    recorder.install(metrics.STAGE_SECONDS)
+
+    server = start_app(_free_port())
+    client = Client(server.config.port)
+    report = []
+    try:
+        for name in scenarios:
+            recorder.scenario = name
+            print(f"Running {name} ...", file=sys.stderr)
+            start = time.perf_counter()
+            with RSSSampler() as sampler:
+                if name == "upload":
+                    latencies, errors = run_upload(args, client)
+                elif name == "email":
+                    latencies, errors = run_email(args, mailbox, smtp)
+                else:
+                    latencies, errors = run_results(args, client)
+            elapsed = time.perf_counter() - start
+            report.append(summarize(name, latencies, errors, elapsed, sampler, recorder.for_scenario(name)))
+    finally:
+        server.should_exit = True
+        imap.shutdown()
+        smtp.shutdown()
+        os.chdir(REPO_ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    print(f"\nfake model: {fake_model.calls} calls, {fake_model.failures} simulated failures")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+
+from job_queue import GRADER_WORKERS, QueueFull, job_queue
+from metrics import registry
+from response_parser import parse_percentage
+from spool import SpoolTooLarge, iter_file, spool_chunks
+
+logger = logging.getLogger(__name__)
+
+# PDFs accepted in one batch, counting every PDF inside uploaded ZIPs
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "500"))
+# Jobs one batch may have queued or running at once, so a whole class doesn't crowd out other uploads
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", str(GRADER_WORKERS * 2)))
+# Batches kept in memory for progress streams and CSV exports; the oldest finished ones go first
+MAX_BULK_BATCHES = int(os.getenv("MAX_BULK_BATCHES", "100"))
+# Seconds between keep-alive comments on an idle progress stream
+SSE_KEEPALIVE_INTERVAL = 15
+# Leading characters that make spreadsheet apps evaluate a CSV cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+BULK_FILES = registry.counter("grader_bulk_files_total", "Files received through bulk uploads", ("status",))
+
+
+class BatchTooLarge(Exception):
+    pass
+
+
+class BulkItem:
+    def __init__(self, filename, path=None, error=None):
+        self.filename = filename
+        self.path = path
+        # Position in the batch, set by BulkBatch; filenames can repeat, so progress is keyed on this
+        self.index = None
+        # pending -> queued -> done | failed; skipped if it never got to the grading queue
+        self.status = "pending" if path else "skipped"
+        self.job_id = None
+        self.result = None
+        self.error = error
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "filename": self.filename,
+            "status": self.status,
+            "job_id": self.job_id,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class BulkBatch:
+    """A set of uploaded PDFs graded together, with a replayable log of progress events."""
+
+    def __init__(self, items, rubric, force):
+        self.id = uuid.uuid4().hex
+        self.items = items
+        for index, item in enumerate(items):
+            item.index = index
+        self.rubric = rubric
+        self.force = force
+        self.created_at = time.time()
+        self.finished_at = None
+        self._events = []
+        # (event loop, asyncio.Event) per open progress stream, woken from the grading threads
+        self._listeners = set()
+        self._lock = threading.RLock()
+        self._slots = threading.BoundedSemaphore(BULK_MAX_IN_FLIGHT)
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def counts(self):
+        counts = {"total": len(self.items)}
+        for item in self.items:
+            counts[item.status] = counts.get(item.status, 0) + 1
+        return counts
+
+    def to_dict(self):
+        return {
+            "batch_id": self.id,
+            "rubric": self.rubric,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "counts": self.counts(),
+            "files": [item.to_dict() for item in self.items],
+        }
+
+    def _emit(self, event, data):
+        with self._lock:
+            self._events.append((len(self._events), event, data))
+            for loop, changed in self._listeners:
+                try:
+                    loop.call_soon_threadsafe(changed.set)
+                except RuntimeError:
+                    # The stream's event loop has shut down
+                    pass
+
+    async def events_after(self, seq, timeout=SSE_KEEPALIVE_INTERVAL):
+        """Events with an id above `seq`, waiting up to `timeout` seconds for one to arrive.
+
+        Waits on the event loop, so an open progress stream doesn't hold a thread.
+        """
+        listener = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            if len(self._events) > seq + 1:
+                return self._events[seq + 1:]
+            self._listeners.add(listener)
+        try:
+            await asyncio.wait_for(listener[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._listeners.discard(listener)
+        with self._lock:
+            return self._events[seq + 1:]
+
+    def run(self, grade_func):
+        """Feed the batch's PDFs to the grading queue, at most BULK_MAX_IN_FLIGHT at a time."""
+        for item in self.items:
+            BULK_FILES.inc(status="skipped" if item.status == "skipped" else "accepted")
+            if item.status == "skipped":
+                self._emit("file", item.to_dict())
+        for item in self.items:
+            if item.status != "pending":
+                continue
+            self._slots.acquire()
+            while True:
+                try:
+                    job = job_queue.submit(
+                        grade_func,
+                        (item.path, item.filename),
+                        {"rubric_name": self.rubric, "force": self.force},
+                        key=f"{item.path}:{item.filename}:{self.rubric}:{self.force}",
+                        resource=item.path,
+                    )
+                    break
+                except QueueFull:
+                    # Backpressure from the shared queue; wait for room rather than fail the file
+                    time.sleep(1)
+            item.status = "queued"
+            item.job_id = job.id
+            self._emit("file", item.to_dict())
+            job.add_done_callback(lambda job, item=item: self._job_finished(item, job))
+        self._check_finished()
+
+    def _job_finished(self, item, job):
+        self._slots.release()
+        # One critical section, so the last file's event is always logged before "done"
+        with self._lock:
+            item.status = job.status
+            item.result = job.result
+            item.error = job.error
+            self._emit("file", item.to_dict())
+            self._check_finished()
+
+    def _check_finished(self):
+        with self._lock:
+            if self.finished or any(item.status in ("pending", "queued") for item in self.items):
+                return
+            self.finished_at = time.time()
+            self._emit("done", {"batch_id": self.id, "counts": self.counts()})
+        logger.info("Bulk batch %s finished: %s", self.id, self.counts())
+
+    def to_csv(self):
+        """One row per file: grade, flags and a column per criterion score."""
+        criteria = []
+        for item in self.items:
+            for score in (item.result or {}).get("criteria_scores", []):
+                if isinstance(score, dict) and score.get("criterion") not in criteria:
+                    criteria.append(score.get("criterion"))
+        out = io.StringIO()
+        writer = csv.writer(out)
+        header = ["filename", "status", "student_name", "overall_grade", "grade_percent",
+                  "similarity_flagged", "error"] + criteria
+        writer.writerow([_csv_cell(value) for value in header])
+        for item in self.items:
+            result = item.result or {}
+            scores = {
+                score.get("criterion"): score.get("score")
+                for score in result.get("criteria_scores", []) if isinstance(score, dict)
+            }
+            writer.writerow([_csv_cell(value) for value in [
+                item.filename,
+                item.status,
+                result.get("student_name", ""),
+                result.get("overall_grade", ""),
+                parse_percentage(result.get("overall_grade")) if result else "",
+                result.get("similarity_flagged", ""),
+                item.error or "",
+            ] + [scores.get(criterion, "") for criterion in criteria]])
+        return out.getvalue()
+
+
+def _csv_cell(value):
+    """Quote text a spreadsheet would run as a formula, since filenames and names come from students."""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def format_event(seq, event, data):
+    """One Server-Sent Events message."""
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _members(archive):
+    """(member, path) for each file in an archive, skipping folders and macOS resource forks.
+
+    The path inside the archive is kept, since class exports often hold one
+    folder per student with identically named files.
+    """
+    for member in archive.infolist():
+        name = os.path.basename(member.filename)
+        if member.is_dir() or not name or name.startswith("._") or member.filename.startswith("__MACOSX/"):
+            continue
+        yield member, member.filename.lstrip("/")
+
+
+def _spool_zip(fileobj, items):
+    with zipfile.ZipFile(fileobj) as archive:
+        for member, name in _members(archive):
+            if not name.lower().endswith(".pdf"):
+                items.append(BulkItem(name, error="Not a PDF"))
+                continue
+            try:
+                # Decompressed a chunk at a time straight into the spool
+                with archive.open(member) as data:
+                    items.append(BulkItem(name, spool_chunks(iter_file(data))))
+            except (SpoolTooLarge, RuntimeError, zipfile.BadZipFile, NotImplementedError) as e:
+                # RuntimeError: encrypted member; NotImplementedError: unsupported compression
+                items.append(BulkItem(name, error=str(e)))
+
+
+def _upload_kind(filename, fileobj):
+    """Classify an upload as "zip", "pdf" or None (anything else)."""
+    lower = filename.lower()
+    fileobj.seek(0)
+    if lower.endswith(".zip") or (not lower.endswith(".pdf") and zipfile.is_zipfile(fileobj)):
+        return "zip"
+    fileobj.seek(0)
+    if lower.endswith(".pdf") or fileobj.read(5) == b"%PDF-":
+        return "pdf"
+    return None
+
+
+def _count_pdfs(uploads):
+    count = 0
+    for _, fileobj, kind in uploads:
+        if kind == "pdf":
+            count += 1
+        elif kind == "zip":
+            fileobj.seek(0)
+            try:
+                # Only reads the archive's central directory
+                with zipfile.ZipFile(fileobj) as archive:
+                    count += sum(1 for _, name in _members(archive) if name.lower().endswith(".pdf"))
+            except zipfile.BadZipFile:
+                continue
+    return count
+
+
+def spool_uploads(files):
+    """Spool (filename, file object) uploads, expanding ZIP archives, and return BulkItems.
+
+    Every PDF is streamed into the content-addressed spool in chunks, so
+    neither an archive nor its members are held in memory. Other files are
+    returned as skipped items.
+    """
+    uploads = []
+    for filename, fileobj in files:
+        filename = os.path.basename(filename or "upload.pdf")
+        uploads.append((filename, fileobj, _upload_kind(filename, fileobj)))
+    # Checked before anything is written, so a rejected batch leaves nothing in the spool
+    if _count_pdfs(uploads) > BULK_MAX_FILES:
+        raise BatchTooLarge(f"A batch may contain at most {BULK_MAX_FILES} PDFs")
+
+    items = []
+    for filename, fileobj, kind in uploads:
+        fileobj.seek(0)
+        if kind == "zip":
+            try:
+                _spool_zip(fileobj, items)
+            except zipfile.BadZipFile as e:
+                items.append(BulkItem(filename, error=f"Unreadable ZIP archive: {e}"))
+        elif kind == "pdf":
+            try:
+                items.append(BulkItem(filename, spool_chunks(iter_file(fileobj))))
+            except SpoolTooLarge as e:
+                items.append(BulkItem(filename, error=str(e)))
+        else:
+            items.append(BulkItem(filename, error="Not a PDF"))
+    return items
+
+
+class BulkBatches:
+    def __init__(self, max_batches=MAX_BULK_BATCHES):
+        self.max_batches = max_batches
+        self._batches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, items, grade_func, rubric, force=False):
+        """Register a batch and start feeding it to the grading queue in the background."""
+        batch = BulkBatch(items, rubric, force)
+        with self._lock:
+            self._batches[batch.id] = batch
+            self._prune()
+        thread = threading.Thread(target=batch.run, args=(grade_func,), name=f"bulk-{batch.id[:8]}")
+        thread.daemon = True
+        thread.start()
+        return batch
+
+    def get(self, batch_id):
+        return self._batches.get(batch_id)
+
+    def _prune(self):
+        excess = len(self._batches) - self.max_batches
+        for batch_id in list(self._batches):
+            if excess <= 0:
+                break
+            if self._batches[batch_id].finished:
+                del self._batches[batch_id]
+                excess -= 1
+
+
+bulk_batches = BulkBatches()
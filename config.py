@@ -0,0 +1,8 @@
+"""Loads settings from .env into the environment, once per process.
+
+Modules read their settings with os.getenv when they are imported, so
+entry points import this module before anything else.
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
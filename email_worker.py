@@ -1,139 +1,202 @@
 import imaplib
+import logging
 import email
 import os
+import threading
 import time
-import smtplib
 from email.mime.text import MIMEText
 from email.header import decode_header
-from dotenv import load_dotenv
-from pdf_processor import process_single_pdf
-from grader import grade_assignment
+import config  # noqa: F401  loads .env before the settings below are read
+from pdf_processor import EMAIL_SPOOL_DIR, mark_failed, mark_graded, process_single_pdf
+from similarity_index import grade_checked
 from grader_utils import write_result_to_file
+from job_queue import QueueFull, RetryLater, job_queue
+from imap_client import MailboxSession, decode_part, find_pdf_parts
+from spool import SpoolTooLarge, iter_base64, iter_bytes, spool_chunks
+from mailer import Mailer
+from rubric_registry import DEFAULT_RUBRIC, rubric_registry
+from metrics import registry
 from datetime import datetime, date, timedelta
 import json
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 EMAIL = os.getenv("EMAIL_ADDRESS")
 PASSWORD = os.getenv("EMAIL_PASSWORD")
-INCOMING_DIR = "incoming_pdfs"
-
-os.makedirs(INCOMING_DIR, exist_ok=True)
-
-# Generic rubric for any course
-GENERIC_RUBRIC = """Rubric for Assignment:
-
-Criteria 1: Content Accuracy (40 points)
-- 40 points: All facts, concepts, and information presented are accurate and well-supported.
-- 30 points: Mostly accurate, with minor factual errors or less robust support.
-- 20 points: Several inaccuracies or insufficient evidence to support claims.
-- 10 points: Significant inaccuracies or lack of factual basis.
-
-Criteria 2: Clarity and Organization (30 points)
-- 30 points: The assignment is logically organized, clear, and easy to follow. Ideas are presented coherently.
-- 20 points: Generally organized, but may have minor issues with flow or coherence.
-- 10 points: Somewhat disorganized, with unclear transitions or a weak overall structure.
-- 5 points: Disorganized and difficult to follow.
-
-Criteria 3: Critical Thinking and Analysis (20 points)
-- 20 points: Demonstrates strong critical thinking and insightful analysis of the subject matter.
-- 15 points: Shows some critical thinking, but analysis may be less developed or occasionally lack depth.
-- 10 points: Limited critical thinking or superficial analysis.
-- 5 points: Lacks critical thinking or provides incorrect reasoning.
-
-Criteria 4: Presentation and Communication (10 points)
-- 10 points: Solution is well-organized, legible, and easy to follow. All steps are clearly communicated.
-- 0 points: Solution is disorganized and illegible, making it difficult to understand.
-
-Overall Feedback: Provide constructive feedback on strengths and areas for improvement. Suggest specific actions for the student to take to improve their understanding or performance.
-"""
+mailer = Mailer(EMAIL, PASSWORD)
+registry.callback("mailer_outbox_depth", "Emails waiting to be sent", mailer.depth)
+registry.callback("mailer_sent_total", "Emails delivered", lambda: mailer.sent, kind="counter")
+registry.callback("mailer_retries_total", "Email delivery attempts that were retried", lambda: mailer.retries, kind="counter")
+registry.callback("mailer_dead_lettered_total", "Emails given up on", lambda: mailer.dead_lettered, kind="counter")
+# Seconds between mailbox checks when the server doesn't support IDLE (and the longest IDLE wait)
+EMAIL_POLL_INTERVAL = int(os.getenv("EMAIL_POLL_INTERVAL", "60"))
+EMAIL_USE_IDLE = os.getenv("EMAIL_USE_IDLE", "true").lower() != "false"
+# Messages whose headers and structure are fetched per round trip
+FETCH_BATCH_SIZE = int(os.getenv("EMAIL_FETCH_BATCH_SIZE", "50"))
+# "thread" runs the worker inside the web app; "off" leaves it to an opt-in worker process (see Procfile)
+EMAIL_WORKER = os.getenv("EMAIL_WORKER", "thread").lower()
+# Only the process holding this lock polls the inbox, however many web workers start
+EMAIL_WORKER_LOCK = os.getenv("EMAIL_WORKER_LOCK", "email_worker.lock")
+
+_worker_thread = None
+_worker_lock = threading.Lock()
+
+def _decode_header_value(value):
+    if not value:
+        return ""
+    decoded, encoding = decode_header(value)[0]
+    if isinstance(decoded, bytes):
+        decoded = decoded.decode(encoding or "utf-8")
+    return decoded
+
+def handle_message(session, uid, summary):
+    """Download only the PDF parts of one message and queue each for grading."""
+    headers = email.message_from_bytes(summary.get("BODY[HEADER.FIELDS (FROM SUBJECT)]") or b"")
+    subject = _decode_header_value(headers["Subject"])
+    sender = _decode_header_value(headers["From"])
+    logger.info("Processing email from %s with subject %s", sender, subject)
+
+    pdf_parts = find_pdf_parts(summary.get("BODYSTRUCTURE") or [])
+    if not pdf_parts:
+        logger.info("No PDF attachment found in email from %s with subject %s", sender, subject)
+        return
+
+    # "[rubric: name]" in the subject picks the rubric; otherwise the default one
+    rubric_name = rubric_registry.rubric_for_subject(subject)
+    payloads = session.fetch_parts(uid, [spec for spec, _, _ in pdf_parts])
+    for spec, filename, encoding in pdf_parts:
+        payload = payloads.get(spec)
+        if payload is None:
+            logger.warning("PDF part %s of message %s could not be fetched.", spec, uid)
+            continue
+        # Decoded a chunk at a time into a content-addressed spool file
+        chunks = iter_base64(payload) if encoding == "base64" else iter_bytes(decode_part(payload, encoding))
+        try:
+            filepath = spool_chunks(chunks, directory=EMAIL_SPOOL_DIR)
+        except SpoolTooLarge as e:
+            logger.warning("Skipping PDF %s from %s: %s", filename, sender, e)
+            send_email_error(sender, subject, f"The attachment {filename} is too large to grade.")
+            continue
+        logger.info("Spooled PDF %s to %s", filename, filepath)
+
+        # Process PDF, grade, and send email on a grading worker
+        try:
+            # No key: two students may send the same file, and each needs a reply
+            job_queue.submit(process_and_respond, (filepath, sender, subject, rubric_name), resource=filepath)
+        except QueueFull:
+            # Queue is saturated; grade inline so the inbox loop slows down with it
+            while True:
+                try:
+                    process_and_respond(filepath, sender, subject, rubric_name)
+                    break
+                except RetryLater as e:
+                    time.sleep(e.retry_after)
+
+def poll_mailbox(session):
+    """Process every message that arrived since the last processed UID."""
+    # Before any UID has been recorded, fall back to unseen mail from the last 24 hours
+    date_24_hours_ago = (date.today() - timedelta(days=1)).strftime("%d-%b-%Y")
+    uids = session.new_uids(f'(UNSEEN SENTSINCE "{date_24_hours_ago}")')
+    if uids:
+        logger.info("Found %d new emails.", len(uids))
+    for start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[start:start + FETCH_BATCH_SIZE]
+        summaries = session.fetch_summaries(batch)
+        for uid in batch:
+            try:
+                handle_message(session, uid, summaries.get(uid, {}))
+            except (imaplib.IMAP4.abort, OSError):
+                # Connection problem: leave the message for the next session
+                raise
+            except Exception as e:
+                logger.error("Error processing email %s: %s", uid, e)
+            session.mark_seen(uid)
+            session.mark_processed(uid)
+    return len(uids)
 
 def check_inbox_periodically():
+    """Keep one IMAP session open and grade new submissions as they arrive."""
+    session = MailboxSession(EMAIL, PASSWORD)
+    backoff = 5
     while True:
         try:
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            mail.login(EMAIL, PASSWORD)
-            mail.select("inbox")
-
-            # Calculate date for 24 hours ago
-            date_24_hours_ago = (date.today() - timedelta(days=1)).strftime("%d-%b-%Y")
-            
-            # Search for unseen emails from the last 24 hours
-            status, email_ids = mail.search(None, 
-                                            f'(UNSEEN SENTSINCE "{date_24_hours_ago}")')
-            
-            print(f"Found {len(email_ids[0].split())} unseen emails from the last 24 hours.")
-            for email_id in email_ids[0].split():
-                status, msg_data = mail.fetch(email_id, "(RFC822)")
-                msg = email.message_from_bytes(msg_data[0][1])
-
-                subject, encoding = decode_header(msg["Subject"])[0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode(encoding or "utf-8")
-
-                sender, encoding = decode_header(msg["From"])[0]
-                if isinstance(sender, bytes):
-                    sender = sender.decode(encoding or "utf-8")
-
-                print(f"Processing email from: {sender} with subject: {subject}")
-
-                has_pdf_attachment = False
-                for part in msg.walk():
-                    try:
-                        print(f"Checking part: {part.get_content_type()}")
-                        if part.get_content_maintype() == "application" and part.get_content_subtype() == "pdf":
-                            has_pdf_attachment = True
-                            filename = part.get_filename()
-                            if filename:
-                                filepath = os.path.join(INCOMING_DIR, filename)
-                                print(f"Identified PDF attachment: {filename}. Saving to {filepath}")
-                                with open(filepath, "wb") as f:
-                                    f.write(part.get_payload(decode=True))
-                                print(f"Downloaded PDF: {filename}")
-
-                                # Process PDF, grade, and send email
-                                process_and_respond(filepath, sender, subject)
-                            else:
-                                print("PDF attachment found but no filename.")
-                        elif part.get_content_maintype() == "multipart":
-                            print("Multipart email part, continuing to walk.")
-                        else:
-                            print(f"Skipping non-PDF part: {part.get_content_type()}")
-                    except AttributeError as ae:
-                        print(f"AttributeError when processing email part: {ae}. Part type: {type(part)}. Part content: {part}")
-                        print("This part might not be a valid email.message.Message object.")
-                    except Exception as part_e:
-                        print(f"Unexpected error when processing email part: {part_e}. Part type: {type(part)}")
-                
-                if not has_pdf_attachment:
-                    print(f"No PDF attachment found in email from {sender} with subject: {subject}")
-
-                mail.store(email_id, "+FLAGS", "\\Seen")
-
-            mail.logout()
-
+            if session.mail is None:
+                session.connect()
+                backoff = 5
+            poll_mailbox(session)
+            if EMAIL_USE_IDLE and session.supports_idle():
+                session.idle(EMAIL_POLL_INTERVAL)
+            else:
+                time.sleep(EMAIL_POLL_INTERVAL)
+                # Keeps the session alive and lets the server report new mail
+                session.noop()
         except Exception as e:
-            print(f"Error in email worker: {e}")
-        time.sleep(300)  # Check every 300 seconds (5 minutes)
-
-def process_and_respond(pdf_path, recipient_email, original_subject):
+            logger.error("Error in email worker: %s", e)
+            session.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, EMAIL_POLL_INTERVAL)
+
+def acquire_leader_lock():
+    """Block until this process is the only one on the host allowed to poll the inbox.
+
+    The lock is released by the OS when the process exits, so a standby
+    worker takes over if the leader dies. Returns the open lock file, which
+    must stay open for as long as the lock is needed.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        logger.warning("File locks are not available on this platform; every process will poll the inbox.")
+        return None
+    lock_file = open(EMAIL_WORKER_LOCK, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info("Another process is polling the inbox; waiting as standby.")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    logger.info("Email worker lock acquired by process %d.", os.getpid())
+    return lock_file
+
+def run_email_worker():
+    """Become the inbox leader, then poll forever."""
+    lock_file = acquire_leader_lock()
     try:
-        print(f"Attempting to process PDF: {pdf_path}")
+        check_inbox_periodically()
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+def start_email_worker():
+    """Start the email worker in a background thread, unless EMAIL_WORKER says otherwise."""
+    global _worker_thread
+    if EMAIL_WORKER != "thread":
+        logger.info("EMAIL_WORKER=%s; not polling the inbox from this process.", EMAIL_WORKER)
+        return
+    with _worker_lock:
+        if _worker_thread is None:
+            _worker_thread = threading.Thread(target=run_email_worker, name="email-worker")
+            _worker_thread.daemon = True
+            _worker_thread.start()
+
+def process_and_respond(pdf_path, recipient_email, original_subject, rubric_name=DEFAULT_RUBRIC):
+    try:
+        logger.info("Processing PDF %s", pdf_path)
         extracted_text = process_single_pdf(pdf_path)
-        print(f"Extracted text length: {len(extracted_text)}")
+        logger.debug("Extracted text length: %d", len(extracted_text))
         
         # grade_assignment now returns a dictionary (JSON object)
-        grading_result = grade_assignment(extracted_text, "generic")
+        grading_result = grade_checked(extracted_text, rubric_name, recipient_email, submitter=recipient_email)
         
         # Check if grading_result is an error dictionary
         if isinstance(grading_result, dict) and "error" in grading_result:
-            print(f"Error during grading: {grading_result["error"]}")
+            logger.error("Error during grading %s: %s", pdf_path, grading_result["error"])
             # Ensure the error message is a plain string before passing
             error_msg_to_send = str(grading_result["error"])
+            mark_failed(pdf_path)
             send_email_error(recipient_email, original_subject, error_msg_to_send)
             return
 
-        print(f"Generated rubric feedback: {json.dumps(grading_result, indent=2)}")
+        logger.debug("Generated rubric feedback for %s: %s", pdf_path, grading_result)
 
         # Transform the result to match frontend expectations
 
@@ -147,15 +210,26 @@ def process_and_respond(pdf_path, recipient_email, original_subject):
 
             "grade_output": f"Grade: {grading_result.get('overall_grade', 'N/A')}\n\nFeedback: {grading_result.get('feedback', 'No feedback available')}",\
 
+            "overall_grade": grading_result.get("overall_grade", "N/A"),
+
             "timestamp": "",
 
-            "criteria_scores": grading_result.get("criteria_scores", [])
+            "rubric": rubric_name,
+
+            "criteria_scores": grading_result.get("criteria_scores", []),
+
+            "similar_submissions": grading_result.get("similar_submissions", []),
+
+            "similarity_flagged": grading_result.get("similarity_flagged", False),
+
+            "reused_grade_from": grading_result.get("reused_grade_from")
 
         }
 
         # Save the structured result
         write_result_to_file(frontend_result)
-        print(f"Grading result saved.")
+        mark_graded(pdf_path)
+        logger.info("Grading result for %s saved.", pdf_path)
 
         # Format feedback for email
         feedback_for_email = f"Overall Grade: {grading_result.get("overall_grade", "N/A")}\n\n"
@@ -169,12 +243,21 @@ def process_and_respond(pdf_path, recipient_email, original_subject):
             if detalle:
                 feedback_for_email += f"  (Points lost: {detalle})\n"
         feedback_for_email += f"\nOverall Feedback: {grading_result.get("feedback", "N/A")}"
+        reused = grading_result.get("reused_grade_from")
+        if reused:
+            feedback_for_email += (
+                f"\n\nThis submission is nearly identical to the one you sent on {reused['submitted_at']}, "
+                "so it has been given the same grade."
+            )
 
         send_email_feedback(recipient_email, original_subject, feedback_for_email)
-        print(f"Feedback email sent to {recipient_email}")
 
+    except RetryLater:
+        # Model API is down; the job queue will run this again once it recovers
+        raise
     except Exception as e:
-        print(f"Error processing and responding to PDF {pdf_path}: {e}")
+        logger.error("Error processing and responding to PDF %s: %s", pdf_path, e)
+        mark_failed(pdf_path)
         # Ensure the error message is a plain string before passing
         error_msg_to_send = str(e)
         send_email_error(recipient_email, original_subject, error_msg_to_send)
@@ -186,12 +269,11 @@ def send_email_feedback(recipient_email, original_subject, feedback):
         msg["From"] = EMAIL
         msg["To"] = recipient_email
 
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(EMAIL, PASSWORD)
-            smtp.send_message(msg)
-        print(f"Feedback email sent to {recipient_email}")
+        # Delivered in the background over a shared connection
+        mailer.send(msg)
+        logger.info("Feedback email queued for %s", recipient_email)
     except Exception as e:
-        print(f"Error sending feedback email to {recipient_email}: {e}")
+        logger.error("Error queueing feedback email to %s: %s", recipient_email, e)
 
 def send_email_error(recipient_email, original_subject, error_message):
     try:
@@ -203,13 +285,15 @@ def send_email_error(recipient_email, original_subject, error_message):
         msg["From"] = EMAIL
         msg["To"] = recipient_email
 
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(EMAIL, PASSWORD)
-            smtp.send_message(msg)
-        print(f"Error email sent to {recipient_email}")
+        mailer.send(msg)
+        logger.info("Error email queued for %s", recipient_email)
     except Exception as e:
-        print(f"Error sending error email to {recipient_email}: {e}")
+        logger.error("Error queueing error email to %s: %s", recipient_email, e)
 
 if __name__ == "__main__":
-    print("Email worker started. Checking inbox periodically...")
-    # check_inbox_periodically() # Uncomment to run directly for testing
+    # Opt-in dedicated worker (see Procfile); start the web workers with EMAIL_WORKER=off alongside it
+    from logging_config import configure_logging
+
+    configure_logging()
+    logger.info("Email worker started. Checking inbox periodically...")
+    run_email_worker()
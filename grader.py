@@ -1,80 +1,103 @@
+import logging
 import os
-import google.generativeai as genai
-from dotenv import load_dotenv
 import json
+import config  # noqa: F401  loads .env before the settings below are read
+from grading_cache import cache_key, grading_cache
+from rubric_registry import DEFAULT_RUBRIC, rubric_registry
+from job_queue import RetryLater
+from llm_client import LLMClient
+from metrics import registry, span
+from response_parser import ResponseParseError, extract_json, merge_repair, repair_instructions, validate_grading
 
-load_dotenv()
-
-INCOMING_DIR = "incoming_pdfs"
-
-# Ensure the directory exists (create if not)
-if not os.path.exists(INCOMING_DIR):
-    os.makedirs(INCOMING_DIR)
+logger = logging.getLogger(__name__)
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Add a print statement to check if the API key is loaded
-if GEMINI_API_KEY:
-    print("GEMINI_API_KEY loaded successfully.")
-else:
-    print("GEMINI_API_KEY not found. Please ensure it\"s set in your environment variables.")
-
-genai.configure(api_key=GEMINI_API_KEY)
-
 # Updated model name based on available models from Render logs
-model = genai.GenerativeModel("gemini-2.5-flash")
+MODEL_NAME = "gemini-2.5-flash"
+
+def _create_model():
+    """Import and configure the Gemini SDK; runs on the first model call, not at import."""
+    import google.generativeai as genai
+
+    if GEMINI_API_KEY:
+        logger.info("GEMINI_API_KEY loaded successfully.")
+    else:
+        logger.warning("GEMINI_API_KEY not found. Please ensure it's set in your environment variables.")
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(MODEL_NAME)
+
+# Rate limits, retries and circuit breaking around every model call
+llm = LLMClient(model_factory=_create_model)
+registry.callback("llm_in_flight", "Model calls currently running", lambda: llm.in_flight)
+registry.callback("llm_calls_total", "Model calls made, including retries", lambda: llm.calls, kind="counter")
+registry.callback("llm_retries_total", "Model calls retried after a transient error", lambda: llm.retries, kind="counter")
+registry.callback("llm_failures_total", "Model calls that failed with a retryable error", lambda: llm.failures, kind="counter")
+registry.callback("llm_throttle_seconds_total", "Time spent waiting on the model rate limits", lambda: llm.throttle_seconds, kind="counter")
+registry.callback("llm_circuit_open", "1 while the model circuit breaker is open", lambda: int(llm.breaker.state != "closed"))
+
+REPAIR_REQUESTS = registry.counter("grader_repair_requests_total", "Follow-up calls asking the model for invalid fields")
+
+# Bump whenever the grading prompt below changes so cached grades from the old prompt are not reused
+PROMPT_VERSION = 2
+# Ask the model for JSON output directly instead of prose that happens to contain JSON
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+# Follow-up calls asking only for the fields that were missing or invalid
+GRADING_REPAIR_ATTEMPTS = int(os.getenv("GRADING_REPAIR_ATTEMPTS", "1"))
 
 def load_rubric(rubric_name):
-    try:
-        with open("rubrics.json", "r") as f:
-            rubrics = json.load(f)
-        return rubrics.get(rubric_name)
-    except FileNotFoundError:
-        print("Error: rubrics.json not found.")
-        return None
-    except json.JSONDecodeError:
-        print("Error: Could not decode rubrics.json. Check JSON format.")
-        return None
-
-def format_rubric_for_prompt(rubric_data):
-    if not rubric_data:
-        return "No rubric provided."
-    
-    formatted_rubric = f"Rubric Name: {rubric_data.get("name", "N/A")}\n"
-    formatted_rubric += f"Description: {rubric_data.get("description", "N/A")}\n\n"
-    
-    for criterion in rubric_data.get("criteria", []):
-        formatted_rubric += f"Criteria: {criterion.get("title", "N/A")} ({criterion.get("points", 0)} points)\n"
-        formatted_rubric += f"Description: {criterion.get("description", "N/A")}\n"
-        formatted_rubric += "\n"
-    return formatted_rubric
-
-def grade_assignment(assignment_text, rubric_name="generic"):
-    rubric_data = load_rubric(rubric_name)
-    formatted_rubric = format_rubric_for_prompt(rubric_data)
-
-    if not rubric_data:
+    """Return the compiled rubric for `rubric_name`, or None if it doesn't exist."""
+    return rubric_registry.get(rubric_name)
+
+# Define the JSON structure as a Python dictionary
+GRADING_JSON_STRUCTURE = {
+    "student_name": "[Student's Name, extracted from the assignment if possible, otherwise 'Unknown']",
+    "overall_grade": "[Overall percentage grade, e.g., '85%']",
+    "feedback": "[Overall comprehensive feedback]",
+    "criteria_scores": [
+        {
+            "criterion": "[Criterion Name]",
+            "score": "[Score for this criterion]",
+            "justification": "[Brief justification based on the rubric and submission]",
+            "detalle": "[Where points were lost, if applicable]"
+        }
+    ]
+}
+
+# Convert the dictionary to a JSON string, handling all escaping automatically
+JSON_FORMAT_INSTRUCTION = json.dumps(GRADING_JSON_STRUCTURE, indent=4)
+BATCH_JSON_FORMAT_INSTRUCTION = json.dumps([dict(submission_id="[Submission id]", **GRADING_JSON_STRUCTURE)], indent=4)
+
+def grading_cache_key(assignment_text, rubric):
+    return cache_key(assignment_text, rubric.prompt, PROMPT_VERSION, MODEL_NAME)
+
+def response_text(response):
+    if hasattr(response, 'text'):
+        return response.text
+    if isinstance(response, str):
+        return response
+    return str(response)
+
+def grade_assignment(assignment_text, rubric_name=DEFAULT_RUBRIC, force=False):
+    """Grade an assignment against a rubric.
+
+    Identical submissions are answered from the grading cache; pass
+    force=True to skip the lookup and regrade.
+    """
+    rubric = load_rubric(rubric_name)
+    if rubric is None:
         return {"error": f"Rubric {rubric_name} not found or could not be loaded."}
+    formatted_rubric = rubric.prompt
+
+    key = grading_cache_key(assignment_text, rubric)
+    if not force:
+        cached = grading_cache.get(key)
+        if cached is not None:
+            logger.debug("Grading cache hit; skipping model call.")
+            return cached
 
-    # Define the JSON structure as a Python dictionary
-    json_structure = {
-        "student_name": "[Student's Name, extracted from the assignment if possible, otherwise 'Unknown']",
-        "overall_grade": "[Overall percentage grade, e.g., '85%']",
-        "feedback": "[Overall comprehensive feedback]",
-        "criteria_scores": [
-            {
-                "criterion": "[Criterion Name]",
-                "score": "[Score for this criterion]",
-                "justification": "[Brief justification based on the rubric and submission]",
-                "detalle": "[Where points were lost, if applicable]"
-            }
-        ]
-    }
-
-    # Convert the dictionary to a JSON string, handling all escaping automatically
-    json_format_instruction = json.dumps(json_structure, indent=4)
-
-    prompt = f"""You are an AI assistant acting as a Professional Lecturer or a Senior Teacher. Your task is to grade assignments based on the provided rubric. 
+    with span("prompt_build"):
+        prompt = f"""You are an AI assistant acting as a Professional Lecturer or a Senior Teacher. Your task is to grade assignments based on the provided rubric. 
     
     Here is the rubric for the assignment:
     {formatted_rubric}
@@ -85,44 +108,124 @@ def grade_assignment(assignment_text, rubric_name="generic"):
     Please provide a detailed grading based on the rubric, including a score for each criterion and overall feedback. 
     Your response MUST be a valid JSON object ONLY. Do NOT include any other text, explanations, or formatting outside the JSON object. 
     The JSON object should strictly follow this format:
-{json_format_instruction}
+{JSON_FORMAT_INSTRUCTION}
     """
 
+    raw_response_text = ""
     try:
-        response = model.generate_content(prompt)
-        print(f"Type of response from model.generate_content: {type(response)}")
-        print(f"Content of response from model.generate_content: {response}")
-
-        raw_response_text = ""
-        if hasattr(response, 'text'):
-            raw_response_text = response.text
-        elif isinstance(response, str):
-            raw_response_text = response
-        else:
-            raw_response_text = str(response)
-
-        # Attempt to extract JSON from the raw response text
-        json_start = raw_response_text.find('{')
-        json_end = raw_response_text.rfind('}')
-
-        if json_start != -1 and json_end != -1 and json_end > json_start:
-            json_string = raw_response_text[json_start : json_end + 1]
-            try:
-                json_response = json.loads(json_string)
-                print(f"Successfully parsed JSON: {json_response}")
-                return json_response
-            except json.JSONDecodeError as e:
-                print(f"Error decoding extracted JSON: {e}")
-                print(f"Extracted JSON string: {json_string}")
-                return {"error": f"Failed to parse AI response as JSON: {e}", "raw_response": raw_response_text}
-        else:
-            print(f"No valid JSON object found in AI response: {raw_response_text}")
-            return {"error": "No valid JSON object found in AI response", "raw_response": raw_response_text}
-
+        response = llm.generate_content(prompt, generation_config=JSON_GENERATION_CONFIG)
+        raw_response_text = response_text(response)
+        with span("parse"):
+            grading, problems = validate_grading(extract_json(raw_response_text), rubric)
+
+        for _ in range(GRADING_REPAIR_ATTEMPTS):
+            if not problems:
+                break
+            logger.info("Asking the model again for %d invalid fields: %s", len(problems), ", ".join(problems))
+            REPAIR_REQUESTS.inc()
+            repair = request_repair(assignment_text, rubric, grading, problems)
+            with span("parse"):
+                grading, problems = validate_grading(merge_repair(grading, repair), rubric)
+
+        if problems:
+            details = "; ".join(f"{field}: {reason}" for field, reason in problems.items())
+            logger.warning("AI response still invalid after repair: %s", details)
+            return {"error": f"AI response has missing or invalid fields: {details}", "raw_response": raw_response_text}
+
+        grading_cache.put(key, grading)
+        return grading
+
+    except ResponseParseError as e:
+        logger.warning("%s: %s", e, raw_response_text[:500])
+        return {"error": str(e), "raw_response": raw_response_text}
+    except RetryLater:
+        # The API is down; let the job queue hold the submission instead of failing it
+        raise
     except Exception as e:
-        print(f"Error during grading: {e}")
+        logger.error("Error during grading: %s", e)
         return {"error": f"Error during grading: {e}"}
 
+def request_repair(assignment_text, rubric, grading, problems):
+    """Ask the model for just the fields listed in `problems`; returns the parsed JSON or {}."""
+    fields, shape = repair_instructions(rubric, problems)
+    prompt = f"""You are an AI assistant acting as a Professional Lecturer or a Senior Teacher. You already graded the assignment below, but some fields of your grading were missing or invalid.
+
+    Here is the rubric for the assignment:
+    {rubric.prompt}
+
+    Here is the student's assignment:
+    {assignment_text}
+
+    Here is the valid part of your grading, which you must NOT repeat:
+{json.dumps(grading, indent=4)}
+
+    Provide ONLY these fields:
+{fields}
+
+    Your response MUST be a valid JSON object ONLY, following this format:
+{shape}
+    """
+    response = llm.generate_content(prompt, generation_config=JSON_GENERATION_CONFIG)
+    try:
+        return extract_json(response_text(response))
+    except ResponseParseError as e:
+        logger.warning("Could not parse repair response: %s", e)
+        return {}
+
+def grade_batch(submissions, rubric_name=DEFAULT_RUBRIC):
+    """Grade several short submissions that share a rubric in a single model call.
+
+    `submissions` is a list of (submission_id, assignment_text). Returns a
+    dict of submission_id -> grading result for every submission the model
+    answered with a JSON object; missing ids should be graded individually.
+    """
+    rubric = load_rubric(rubric_name)
+    if rubric is None:
+        return {}
+
+    submission_blocks = "\n\n".join(
+        f"=== Submission {submission_id} ===\n{text}\n=== End of submission {submission_id} ==="
+        for submission_id, text in submissions
+    )
+    prompt = f"""You are an AI assistant acting as a Professional Lecturer or a Senior Teacher. Your task is to grade assignments based on the provided rubric.
+
+    Here is the rubric for the assignments:
+    {rubric.prompt}
+
+    Below are {len(submissions)} independent student assignments. Grade each one on its own merits; do not compare them.
+
+{submission_blocks}
+
+    Please provide a detailed grading of every submission based on the rubric, including a score for each criterion and overall feedback.
+    Your response MUST be a valid JSON array ONLY, with exactly one object per submission, each carrying its submission_id. Do NOT include any other text, explanations, or formatting outside the JSON array.
+    The JSON array should strictly follow this format:
+{BATCH_JSON_FORMAT_INSTRUCTION}
+    """
+
+    try:
+        response = llm.generate_content(prompt, generation_config=JSON_GENERATION_CONFIG)
+        graded = extract_json(response_text(response), opener="[")
+    except RetryLater:
+        raise
+    except Exception as e:
+        logger.error("Error during batch grading: %s", e)
+        return {}
+
+    expected_ids = {str(submission_id) for submission_id, _ in submissions}
+    results = {}
+    for item in graded if isinstance(graded, list) else []:
+        if not isinstance(item, dict):
+            continue
+        submission_id = str(item.pop("submission_id", ""))
+        if submission_id not in expected_ids:
+            continue
+        grading, problems = validate_grading(item, rubric)
+        # Incomplete entries are left out so they get a full single-submission grading
+        if not problems:
+            results[submission_id] = grading
+    logger.info("Batch graded %d of %d submissions in one call.", len(results), len(submissions))
+    return results
+
 if __name__ == "__main__":
     # Example usage:
     sample_assignment = """The student solved the quadratic equation x^2 - 4x + 4 = 0 by factoring. They correctly identified that the equation factors to (x-2)^2 = 0, and thus x=2. The steps were clear and easy to follow. However, they did not show any work for how they arrived at the factored form.\n"""
@@ -1,35 +1,28 @@
 import json
-import os
+import logging
 
-RESULTS_FILE = "grading_results.json"
+from metrics import span
+from results_store import store
 
-def write_result_to_file(result):
-    if os.path.exists(RESULTS_FILE):
-        with open(RESULTS_FILE, "r") as f:
-            data = json.load(f)
-    else:
-        data = []
+logger = logging.getLogger(__name__)
 
+def write_result_to_file(result):
     # Ensure result is a dictionary before appending
-    if isinstance(result, dict):
-        data.append(result)
-    else:
-        print(f"Warning: Attempted to write non-dictionary result to file: {result}")
+    if not isinstance(result, dict):
+        logger.warning("Attempted to write non-dictionary result to file: %r", result)
         # Optionally, you could try to parse it if it's a string that should be JSON
         try:
-            parsed_result = json.loads(result)
-            data.append(parsed_result)
+            result = json.loads(result)
         except (json.JSONDecodeError, TypeError):
-            print(f"Error: Could not parse and write result to file: {result}")
-            # If it's still not a dict or parsable JSON, you might want to log it differently
+            logger.error("Could not parse and write result to file: %r", result)
+            return None
+        if not isinstance(result, dict):
+            logger.error("Could not parse and write result to file: %r", result)
+            return None
 
-    with open(RESULTS_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+    # A single append; cost does not depend on how many results are already stored
+    with span("results_write"):
+        return store.append(result)
 
 def read_all_results():
-    if os.path.exists(RESULTS_FILE):
-        with open(RESULTS_FILE, "r") as f:
-            data = json.load(f)
-        return data
-    return []
-
+    return store.all()
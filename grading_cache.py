@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import registry
+
+CACHE_DB = os.getenv("GRADING_CACHE_DB", "grading_cache.db")
+CACHE_MAX_ENTRIES = int(os.getenv("GRADING_CACHE_MAX_ENTRIES", "5000"))
+CACHE_MAX_BYTES = int(os.getenv("GRADING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Cached grades older than this (seconds) are ignored and regraded; 0 disables expiry
+CACHE_TTL = int(os.getenv("GRADING_CACHE_TTL", str(30 * 24 * 3600)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS grading_cache (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_grading_cache_last_access ON grading_cache(last_access);
+"""
+
+
+def normalize_text(text):
+    """Collapse whitespace so re-extractions of the same PDF hash identically."""
+    return " ".join((text or "").split())
+
+
+def cache_key(assignment_text, formatted_rubric, prompt_version, model_name):
+    digest = hashlib.sha256()
+    for part in (normalize_text(assignment_text), formatted_rubric, str(prompt_version), model_name):
+        digest.update(part.encode("utf-8"))
+        # Separator so the field boundaries can't be shifted to forge a collision
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class GradingCache:
+    """Persistent, size-bounded LRU cache of grading results keyed by content hash."""
+
+    def __init__(self, path=CACHE_DB, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _count(self, attribute):
+        with self._counter_lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def get(self, key):
+        """Return the cached grading result for `key`, or None on a miss."""
+        conn = self._connect()
+        row = conn.execute("SELECT result, created_at FROM grading_cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.ttl and now - row[1] > self.ttl):
+            if row is not None:
+                conn.execute("DELETE FROM grading_cache WHERE key = ?", (key,))
+            self._count("misses")
+            return None
+        conn.execute("UPDATE grading_cache SET last_access = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        serialized = json.dumps(result)
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO grading_cache (key, result, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, serialized, len(serialized), now, now),
+        )
+        self._evict(conn)
+
+    def _evict(self, conn):
+        """Drop least recently used entries until both the entry and byte limits hold."""
+        count, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM grading_cache").fetchone()
+        while count > self.max_entries or total_bytes > self.max_bytes:
+            row = conn.execute("SELECT key, size FROM grading_cache ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            conn.execute("DELETE FROM grading_cache WHERE key = ?", (row[0],))
+            count -= 1
+            total_bytes -= row[1]
+            self._count("evictions")
+
+    def clear(self):
+        self._connect().execute("DELETE FROM grading_cache")
+
+    def stats(self):
+        count, total_bytes = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM grading_cache"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "bytes": total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+grading_cache = GradingCache()
+registry.callback("grading_cache_hits_total", "Gradings answered from the cache", lambda: grading_cache.hits, kind="counter")
+registry.callback("grading_cache_misses_total", "Cache lookups that needed a model call", lambda: grading_cache.misses, kind="counter")
+registry.callback("grading_cache_evictions_total", "Cached gradings evicted", lambda: grading_cache.evictions, kind="counter")
+registry.callback(
+    "grading_cache_hit_ratio",
+    "Share of cache lookups that were hits",
+    lambda: grading_cache.hits / (grading_cache.hits + grading_cache.misses) if grading_cache.hits + grading_cache.misses else 0,
+)
@@ -0,0 +1,270 @@
+import base64
+import imaplib
+import json
+import os
+import quopri
+import re
+import select
+
+IMAP_HOST = os.getenv("IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+# Set IMAP_SSL=false to talk plain IMAP, e.g. to a local test server
+IMAP_SSL = os.getenv("IMAP_SSL", "true").lower() != "false"
+IMAP_MAILBOX = os.getenv("IMAP_MAILBOX", "inbox")
+# Where the last processed UIDVALIDITY/UID are remembered between restarts
+EMAIL_STATE_FILE = os.getenv("EMAIL_STATE_FILE", "email_state.json")
+
+_LITERAL = re.compile(rb"\{(\d+)\}\r\n")
+
+
+def parse_imap(data, pos=0):
+    """Parse one IMAP value (atom, string, literal, NIL or parenthesised list) from `data`.
+
+    Returns (value, next_pos). Strings and atoms come back as str, literals
+    as bytes, NIL as None and lists as Python lists.
+    """
+    while pos < len(data) and data[pos:pos + 1] == b" ":
+        pos += 1
+    char = data[pos:pos + 1]
+    if char == b"(":
+        items = []
+        pos += 1
+        while True:
+            while data[pos:pos + 1] == b" ":
+                pos += 1
+            if data[pos:pos + 1] == b")":
+                return items, pos + 1
+            if pos >= len(data):
+                raise ValueError("Unterminated IMAP list")
+            item, pos = parse_imap(data, pos)
+            items.append(item)
+    if char == b'"':
+        pos += 1
+        out = bytearray()
+        while data[pos:pos + 1] != b'"':
+            if data[pos:pos + 1] == b"\\":
+                pos += 1
+            out += data[pos:pos + 1]
+            pos += 1
+            if pos >= len(data):
+                raise ValueError("Unterminated IMAP string")
+        return out.decode("utf-8", "replace"), pos + 1
+    literal = _LITERAL.match(data, pos)
+    if literal:
+        start = literal.end()
+        end = start + int(literal.group(1))
+        return data[start:end], end
+    # Atom; section specs like BODY[HEADER.FIELDS (FROM)] contain spaces and parens
+    start = pos
+    depth = 0
+    while pos < len(data):
+        char = data[pos:pos + 1]
+        if char == b"[":
+            depth += 1
+        elif char == b"]":
+            depth -= 1
+        elif depth == 0 and char in (b" ", b"(", b")"):
+            break
+        pos += 1
+    atom = data[start:pos].decode("utf-8", "replace")
+    return (None if atom.upper() == "NIL" else atom), pos
+
+
+def parse_fetch_response(response):
+    """Turn imaplib's FETCH response list into {uid: {ITEM: value}}."""
+    # Rebuild the wire format (literals inline) so one parser handles everything
+    messages = []
+    for item in response:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            chunk = item[0] + b"\r\n" + item[1]
+        else:
+            chunk = item
+        if re.match(rb"\d+ \(", chunk):
+            messages.append(bytearray(chunk))
+        elif messages:
+            messages[-1] += chunk
+    parsed = {}
+    for raw in messages:
+        _, pos = parse_imap(bytes(raw))
+        values, _ = parse_imap(bytes(raw), pos)
+        fields = {str(values[i]).upper(): values[i + 1] for i in range(0, len(values) - 1, 2)}
+        if "UID" in fields:
+            parsed[int(fields["UID"])] = fields
+    return parsed
+
+
+def _params_to_dict(params):
+    if not isinstance(params, list):
+        return {}
+    return {str(params[i]).lower(): params[i + 1] for i in range(0, len(params) - 1, 2)}
+
+
+def find_pdf_parts(structure, prefix=""):
+    """Walk a BODYSTRUCTURE and return [(part_spec, filename, encoding)] for PDF attachments."""
+    if structure and isinstance(structure[0], list):
+        # multipart: the child bodies come first, then the subtype and extension data
+        parts = []
+        for index, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            parts.extend(find_pdf_parts(child, f"{prefix}{index + 1}."))
+        return parts
+    if len(structure) < 7:
+        return []
+    main_type = str(structure[0]).lower()
+    sub_type = str(structure[1]).lower()
+    params = _params_to_dict(structure[2])
+    encoding = str(structure[5] or "7bit").lower()
+    filename = params.get("name")
+    # Non-text single parts carry disposition at index 8 (after the MD5)
+    disposition = structure[8] if len(structure) > 8 else None
+    if isinstance(disposition, list) and len(disposition) > 1:
+        filename = _params_to_dict(disposition[1]).get("filename", filename)
+    if isinstance(filename, bytes):
+        filename = filename.decode("utf-8", "replace")
+    is_pdf = (main_type, sub_type) == ("application", "pdf") or (
+        main_type == "application" and filename and filename.lower().endswith(".pdf")
+    )
+    if not is_pdf:
+        return []
+    return [((prefix or "1.")[:-1], filename, encoding)]
+
+
+def decode_part(payload, encoding):
+    if isinstance(payload, str):
+        payload = payload.encode("ascii", "replace")
+    if encoding == "base64":
+        return base64.b64decode(payload)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(payload)
+    return payload
+
+
+def load_state():
+    try:
+        with open(EMAIL_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(state):
+    tmp_path = EMAIL_STATE_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, EMAIL_STATE_FILE)
+
+
+class MailboxSession:
+    """A long-lived IMAP session that only fetches messages it has not seen yet.
+
+    Progress is tracked as (UIDVALIDITY, last UID) in EMAIL_STATE_FILE; if the
+    server resets UIDVALIDITY the session starts over from unseen mail.
+    """
+
+    def __init__(self, user, password, host=IMAP_HOST, port=IMAP_PORT, use_ssl=IMAP_SSL, mailbox=IMAP_MAILBOX):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.mailbox = mailbox
+        self.mail = None
+        self.uidvalidity = None
+        self.state = load_state()
+
+    def connect(self):
+        self.close()
+        if self.use_ssl:
+            self.mail = imaplib.IMAP4_SSL(self.host, self.port)
+        else:
+            self.mail = imaplib.IMAP4(self.host, self.port)
+        self.mail.login(self.user, self.password)
+        self.mail.select(self.mailbox)
+        _, data = self.mail.response("UIDVALIDITY")
+        self.uidvalidity = int(data[0]) if data and data[0] else None
+        if self.state.get("uidvalidity") != self.uidvalidity:
+            # UIDs from a previous UIDVALIDITY mean nothing now
+            self.state = {"uidvalidity": self.uidvalidity, "last_uid": None}
+
+    def close(self):
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self.mail = None
+
+    @property
+    def last_uid(self):
+        return self.state.get("last_uid")
+
+    def mark_processed(self, uid):
+        if self.last_uid is None or uid > self.last_uid:
+            self.state["last_uid"] = uid
+            save_state(self.state)
+
+    def new_uids(self, initial_criteria):
+        """UIDs of messages after the last processed one, or matching `initial_criteria` on first run."""
+        if self.last_uid is None:
+            _, data = self.mail.uid("SEARCH", None, initial_criteria)
+        else:
+            _, data = self.mail.uid("SEARCH", None, f"UID {self.last_uid + 1}:*")
+        uids = sorted(int(uid) for uid in (data[0] or b"").split())
+        # "N:*" always matches the newest message, even if it is older than N
+        if self.last_uid is not None:
+            uids = [uid for uid in uids if uid > self.last_uid]
+        return uids
+
+    def fetch_summaries(self, uids):
+        """Headers and BODYSTRUCTURE for a batch of messages, without downloading bodies."""
+        if not uids:
+            return {}
+        uid_set = ",".join(str(uid) for uid in uids)
+        _, data = self.mail.uid("FETCH", uid_set, "(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])")
+        return parse_fetch_response(data)
+
+    def fetch_parts(self, uid, part_specs):
+        """Download only the given body parts of one message."""
+        items = " ".join(f"BODY.PEEK[{spec}]" for spec in part_specs)
+        _, data = self.mail.uid("FETCH", str(uid), f"(UID {items})")
+        fields = parse_fetch_response(data).get(uid, {})
+        return {spec: fields.get(f"BODY[{spec}]") for spec in part_specs}
+
+    def mark_seen(self, uid):
+        self.mail.uid("STORE", str(uid), "+FLAGS", "(\\Seen)")
+
+    def noop(self):
+        self.mail.noop()
+
+    def supports_idle(self):
+        return "IDLE" in self.mail.capabilities
+
+    def idle(self, timeout):
+        """Block in IMAP IDLE for up to `timeout` seconds; True if the server reported a change."""
+        tag = self.mail._new_tag()
+        self.mail.send(tag + b" IDLE\r\n")
+        if not self.mail.readline().startswith(b"+"):
+            raise imaplib.IMAP4.error("Server refused IDLE")
+        sock = self.mail.sock
+        changed = False
+        try:
+            # Wait on the socket rather than a read timeout, which would poison imaplib's file object
+            pending = sock.pending() if hasattr(sock, "pending") else 0
+            if pending or select.select([sock], [], [], timeout)[0]:
+                changed = True
+        finally:
+            self.mail.send(b"DONE\r\n")
+            while True:
+                line = self.mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed during IDLE")
+                if line.startswith(tag):
+                    break
+                if b"EXISTS" in line:
+                    changed = True
+        return changed
+
@@ -0,0 +1,223 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import STAGE_SECONDS, registry
+
+logger = logging.getLogger(__name__)
+
+# Number of grading workers; each one holds a PDF parse or an LLM call at a time
+GRADER_WORKERS = int(os.getenv("GRADER_WORKERS", "4"))
+# Jobs that may wait for a worker before submissions are rejected
+GRADER_QUEUE_SIZE = int(os.getenv("GRADER_QUEUE_SIZE", "200"))
+# Finished jobs kept around for GET /jobs/{id}
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "1000"))
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class RetryLater(Exception):
+    """Raised by a job that can't make progress right now (e.g. the model API is down).
+
+    The queue pauses all workers for `retry_after` seconds and then runs the
+    same job again instead of marking it failed.
+    """
+
+    def __init__(self, message, retry_after=30.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, func, args, kwargs, key=None, resource=None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.resource = resource
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        """Call `callback(job)` once the job finishes (immediately if it already has)."""
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, status, result=None, error=None):
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error("Error in job %s callback: %s", self.id, e)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Bounded queue of grading jobs drained by a fixed pool of worker threads.
+
+    Submitting to a full queue raises QueueFull instead of blocking, so
+    callers can push back on clients (HTTP 503) rather than pile up work.
+    """
+
+    def __init__(self, workers=GRADER_WORKERS, maxsize=GRADER_QUEUE_SIZE):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = OrderedDict()
+        self._active_keys = {}
+        self._busy = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._resume_at = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"grader-{i}")
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, args=(), kwargs=None, key=None, resource=None):
+        """Queue `func(*args, **kwargs)` and return its Job.
+
+        Jobs with a `key` are deduplicated: while one is queued or running,
+        submitting the same key returns the existing job. `resource` names
+        the file a job works on, so is_busy() can tell whether it's in use.
+        """
+        self.start()
+        with self._lock:
+            if key is not None and key in self._active_keys:
+                return self._active_keys[key]
+            job = Job(func, args, kwargs or {}, key=key, resource=resource)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFull(f"Grading queue is full ({self._queue.maxsize} jobs waiting)")
+            self._jobs[job.id] = job
+            if key is not None:
+                self._active_keys[key] = job
+            if resource is not None:
+                self._busy[resource] = self._busy.get(resource, 0) + 1
+            self._prune()
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def is_busy(self, resource):
+        """True while any queued or running job works on `resource`."""
+        return resource in self._busy
+
+    def depth(self):
+        """Number of jobs waiting for a worker."""
+        return self._queue.qsize()
+
+    def free_slots(self):
+        return max(self._queue.maxsize - self._queue.qsize(), 0)
+
+    def pause(self, seconds):
+        """Stop workers from starting jobs for the next `seconds` seconds."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def paused_for(self):
+        return max(self._resume_at - time.monotonic(), 0.0)
+
+    def _wait_until_resumed(self):
+        while True:
+            remaining = self.paused_for()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1.0))
+
+    def _prune(self):
+        # Oldest jobs first; only finished ones are dropped
+        excess = len(self._jobs) - MAX_FINISHED_JOBS
+        if excess <= 0:
+            return
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].done.is_set():
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            self._wait_until_resumed()
+            job.status = "running"
+            job.started_at = time.time()
+            STAGE_SECONDS.observe(job.started_at - job.created_at, stage="queue_wait")
+            try:
+                result = self._run(job)
+            except Exception as e:
+                logger.error("Job %s failed: %s", job.id, e)
+                self._release(job)
+                job._finish("failed", error=str(e))
+            else:
+                self._release(job)
+                job._finish("done", result=result)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        while True:
+            try:
+                return job.func(*job.args, **job.kwargs)
+            except RetryLater as e:
+                logger.warning("Job %s deferred for %.0fs: %s", job.id, e.retry_after, e)
+                job.status = "waiting"
+                self.pause(e.retry_after)
+                self._wait_until_resumed()
+                job.status = "running"
+
+    def _release(self, job):
+        with self._lock:
+            if job.key is not None and self._active_keys.get(job.key) is job:
+                del self._active_keys[job.key]
+            if job.resource is not None:
+                self._busy[job.resource] -= 1
+                if not self._busy[job.resource]:
+                    del self._busy[job.resource]
+
+
+job_queue = JobQueue()
+registry.callback("grader_queue_depth", "Grading jobs waiting for a worker", job_queue.depth)
+registry.callback("grader_queue_paused_seconds", "Seconds until paused grading workers resume", job_queue.paused_for)
@@ -0,0 +1,223 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from job_queue import RetryLater
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "60"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+# Consecutive failed calls that open the circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "60"))
+
+# HTTP-style status codes worth retrying: quota exhaustion and transient server errors
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {
+    "ResourceExhausted",
+    "TooManyRequests",
+    "ServiceUnavailable",
+    "InternalServerError",
+    "DeadlineExceeded",
+    "GatewayTimeout",
+}
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English prose
+    return len(text or "") // 4 + 1
+
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    try:
+        if int(code) in RETRYABLE_CODES:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+class CircuitOpen(RetryLater):
+    """Raised instead of calling the model while the API is considered down."""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute` tokens per minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Take `amount` tokens, sleeping until they are available; returns seconds waited."""
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go ahead; returns True if the call is the probe.
+
+        After `reset_timeout` one probe call is let through (half-open); its
+        outcome decides whether the circuit closes or opens again.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpen("Model API circuit is open", retry_after=remaining)
+            if self._probing:
+                raise CircuitOpen("Model API circuit is half-open; waiting on probe call", retry_after=1.0)
+            self.state = "half_open"
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def release_probe(self):
+        """Let another probe through if the current one ended without a verdict (e.g. interrupted)."""
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                self.state = "open"
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                    logger.warning("Model API circuit opened after %d failures.", self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LLMClient:
+    """Drop-in wrapper around a GenerativeModel adding rate limits, retries and a circuit breaker.
+
+    `generate_content` keeps the model's signature, so callers don't change.
+    While the circuit is open it raises CircuitOpen, which the job queue
+    treats as "pause and retry later" rather than a failed submission.
+    Pass `model_factory` instead of `model` to build the model on first use.
+    """
+
+    def __init__(self, model=None, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 max_attempts=LLM_MAX_ATTEMPTS, breaker=None, model_factory=None):
+        self._model = model
+        self.model_factory = model_factory
+        self._model_lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.breaker = breaker or CircuitBreaker()
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttle_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self.model_factory()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def _add(self, attribute, amount):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + amount)
+
+    def generate_content(self, prompt, **kwargs):
+        # Built before the breaker is consulted, so a failing factory can't strand a half-open probe
+        model = self.model
+        for attempt in range(1, self.max_attempts + 1):
+            probe = self.breaker.before_call()
+            waited = self.request_bucket.acquire(1) + self.token_bucket.acquire(estimate_tokens(prompt))
+            self._add("throttle_seconds", waited)
+            self._add("in_flight", 1)
+            self._add("calls", 1)
+            try:
+                with span("llm_call"):
+                    response = model.generate_content(prompt, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The API answered, so it isn't down; this also settles a half-open probe
+                    self.breaker.record_success()
+                    raise
+                self._add("failures", 1)
+                self.breaker.record_failure()
+                if attempt == self.max_attempts:
+                    # Out of attempts on an error that should clear up: the job queue holds the
+                    # submission and tries again later, instead of the student getting an error
+                    if self.breaker.state == "open":
+                        raise CircuitOpen(f"Model API circuit is open: {e}", retry_after=self.breaker.reset_timeout) from e
+                    raise RetryLater(f"Model API still failing after {attempt} attempts: {e}", retry_after=LLM_BACKOFF_MAX) from e
+                self._add("retries", 1)
+                delay = min(LLM_BACKOFF_BASE * 2 ** (attempt - 1), LLM_BACKOFF_MAX) * (0.5 + random.random())
+                logger.warning("Retryable model error (%s); attempt %d of %d, retrying in %.1fs", e, attempt, self.max_attempts, delay)
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return response
+            finally:
+                self._add("in_flight", -1)
+                if probe:
+                    self.breaker.release_probe()
+
+    def metrics(self):
+        return {
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "throttle_seconds": round(self.throttle_seconds, 3),
+            "circuit_state": self.breaker.state,
+            "circuit_opened": self.breaker.times_opened,
+        }
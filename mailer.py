@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import queue
+import random
+import smtplib
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+# Set SMTP_SSL=false to talk plain SMTP, e.g. to a local debugging server
+SMTP_SSL = os.getenv("SMTP_SSL", "true").lower() != "false"
+# Outgoing messages per minute; Gmail throttles accounts that burst
+SMTP_MAX_PER_MINUTE = float(os.getenv("SMTP_MAX_PER_MINUTE", "30"))
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", "5"))
+# Seconds an unused connection is kept open, and how stale it may get before a NOOP check
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "120"))
+SMTP_KEEPALIVE_AFTER = float(os.getenv("SMTP_KEEPALIVE_AFTER", "30"))
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", "1000"))
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "undeliverable_emails.jsonl")
+
+
+class Mailer:
+    """Background sender that reuses one authenticated SMTP connection.
+
+    `send` only queues the message; a single thread delivers the queue with
+    rate limiting and retries, and writes messages it can't deliver to
+    DEAD_LETTER_FILE.
+    """
+
+    def __init__(self, user, password, host=SMTP_HOST, port=SMTP_PORT, use_ssl=SMTP_SSL,
+                 max_per_minute=SMTP_MAX_PER_MINUTE, max_attempts=SMTP_MAX_ATTEMPTS):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.min_interval = 60.0 / max_per_minute if max_per_minute > 0 else 0.0
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.retries = 0
+        self.dead_lettered = 0
+        self._queue = queue.Queue(maxsize=OUTBOX_SIZE)
+        self._conn = None
+        self._last_used = 0.0
+        self._next_send_at = 0.0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def send(self, msg):
+        """Queue a message for delivery and return immediately."""
+        self._start()
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self._dead_letter(msg, "Outbox full")
+
+    def flush(self):
+        """Block until every queued message has been delivered or dead-lettered."""
+        self._queue.join()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="mailer")
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            try:
+                msg = self._queue.get(timeout=SMTP_IDLE_TIMEOUT)
+            except queue.Empty:
+                self._close()
+                continue
+            try:
+                self._deliver(msg)
+            except Exception as e:
+                self._dead_letter(msg, str(e))
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, msg):
+        for attempt in range(1, self.max_attempts + 1):
+            self._throttle()
+            try:
+                with span("smtp_send"):
+                    self._connection().send_message(msg)
+                self._last_used = time.monotonic()
+                self.sent += 1
+                logger.info("Email sent to %s", msg["To"])
+                return
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+                # Permanent: retrying the same address won't help
+                self._dead_letter(msg, str(e))
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                if attempt == self.max_attempts:
+                    self._dead_letter(msg, str(e))
+                    return
+                self.retries += 1
+                delay = min(2 ** attempt, 60) * (0.5 + random.random())
+                logger.warning("Error sending email to %s (attempt %d): %s. Retrying in %.1fs", msg["To"], attempt, e, delay)
+                time.sleep(delay)
+
+    def _throttle(self):
+        now = time.monotonic()
+        if now < self._next_send_at:
+            time.sleep(self._next_send_at - now)
+        self._next_send_at = max(now, self._next_send_at) + self.min_interval
+
+    def _connection(self):
+        if self._conn is not None and time.monotonic() - self._last_used > SMTP_KEEPALIVE_AFTER:
+            # The server may have dropped an idle connection; check before reusing it
+            try:
+                if self._conn.noop()[0] != 250:
+                    self._close()
+            except (smtplib.SMTPException, OSError):
+                self._close()
+        if self._conn is None:
+            if self.use_ssl:
+                conn = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+            else:
+                conn = smtplib.SMTP(self.host, self.port, timeout=30)
+            conn.ehlo()
+            # Local debugging servers don't offer AUTH
+            if conn.has_extn("auth"):
+                conn.login(self.user, self.password)
+            self._conn = conn
+            self._last_used = time.monotonic()
+        return self._conn
+
+    def _close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._conn = None
+
+    def _dead_letter(self, msg, error):
+        self.dead_lettered += 1
+        logger.error("Giving up on email to %s: %s", msg["To"], error)
+        entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "to": msg["To"],
+            "subject": msg["Subject"],
+            "error": error,
+            "message": msg.as_string(),
+        }
+        with open(DEAD_LETTER_FILE, "a") as f:
+            f.write(json.dumps(entry) + "\n")
@@ -1,16 +1,36 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import FileResponse, HTMLResponse
+from contextlib import asynccontextmanager
+import config  # noqa: F401  loads .env once, before any settings are read
+from fastapi import FastAPI, UploadFile, File, Request, Query, HTTPException
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from email_worker import check_inbox_periodically
-from grader_utils import read_all_results, write_result_to_file
-from pdf_processor import process_single_pdf
-from grader import grade_assignment
-import threading
+from starlette.concurrency import run_in_threadpool
+from logging_config import configure_logging
+
+# Before the other imports, which log while they load
+configure_logging()
+
+from metrics import registry, span
+from email_worker import start_email_worker
+from grader_utils import write_result_to_file
+from results_store import results_index, store
+from pdf_processor import INCOMING_DIR, mark_failed, mark_graded, process_single_pdf
+from similarity_index import grade_checked
+from grader import llm
+from job_queue import QueueFull, RetryLater, job_queue
+from rubric_registry import DEFAULT_RUBRIC, rubric_registry
+from bulk_upload import BatchTooLarge, bulk_batches, format_event, spool_uploads
+from spool import MAX_UPLOAD_BYTES, SpoolTooLarge, spool_file, start_cleanup
 import os
-import shutil
 import json
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    start_cleanup()
+    # Starts at most one inbox poller per host; see EMAIL_WORKER and EMAIL_WORKER_LOCK
+    start_email_worker()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,8 +38,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Has-More"],
 )
 
+# Upper bound on the page size a client can ask /results/ for
+MAX_RESULTS_PAGE = 1000
+
 @app.get("/")
 async def serve_home():
     """Serve the main index.html file"""
@@ -30,55 +54,267 @@ async def serve_css():
     """Serve the CSS file"""
     return FileResponse("style.css")
 
-@app.post("/upload-pdf/")
-async def upload_pdf(file: UploadFile = File(...)):
-    file_path = f"./{file.filename}"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
+def grade_pdf(file_path, filename, rubric_name=DEFAULT_RUBRIC, force=False):
+    """Extract, grade and store one PDF. Runs on a grading worker, not the event loop."""
+    with span("submission"):
+        try:
+            return _grade_pdf(file_path, filename, rubric_name, force)
+        except RetryLater:
+            # The job queue runs it again once the model API recovers
+            raise
+        except Exception:
+            mark_failed(file_path)
+            raise
+
+def _grade_pdf(file_path, filename, rubric_name, force):
     # Process the PDF and extract text
-    text = process_single_pdf(file_path)    
-    # Grade the assignment, passing the generic rubric
-    rubric_feedback = grade_assignment(text, "generic")
-    
+    text = process_single_pdf(file_path)
+    # Grade the assignment against the chosen rubric
+    # force=true regrades even if an identical submission is already cached
+    # Also reports earlier submissions this one closely resembles
+    # No submitter: a filename says nothing about who uploaded it, so uploads never reuse a grade
+    rubric_feedback = grade_checked(text, rubric_name, filename, force=force)
+    if "error" in rubric_feedback:
+        raise RuntimeError(rubric_feedback["error"])
+
     # Transform the response to match frontend expectations
     result = {
-        "filename": file.filename,
+        "filename": filename,
         "student_name": rubric_feedback.get("student_name", "Unknown"),
         "overall_grade": rubric_feedback.get("overall_grade", "N/A"),
         "feedback": rubric_feedback.get("feedback", "No feedback available"),
-        "criteria_scores": rubric_feedback.get("criteria_scores", [])
+        "criteria_scores": rubric_feedback.get("criteria_scores", []),
+        "token_report": rubric_feedback.get("token_report"),
+        "similar_submissions": rubric_feedback.get("similar_submissions", []),
+        "similarity_flagged": rubric_feedback.get("similarity_flagged", False),
+        "reused_grade_from": rubric_feedback.get("reused_grade_from"),
     }
-    
+
     # Save to results file with frontend-compatible format
     frontend_result = {
         "name": result["student_name"],
         "email": "",  # Not available from PDF upload
         "course": "Unknown Course",  # Could be extracted or set
         "grade_output": f"Grade: {result['overall_grade']}\n\nFeedback: {result['feedback']}",
+        "overall_grade": result["overall_grade"],
         "timestamp": "",
-        "criteria_scores": result["criteria_scores"]
+        "rubric": rubric_name,
+        "criteria_scores": result["criteria_scores"],
+        "similar_submissions": result["similar_submissions"],
+        "similarity_flagged": result["similarity_flagged"],
+        "reused_grade_from": result["reused_grade_from"],
     }
-    
+
     write_result_to_file(frontend_result)
-    
+    mark_graded(file_path)
+
     return result
 
+def require_rubric(rubric_name):
+    if rubric_registry.get(rubric_name) is None:
+        raise HTTPException(status_code=400, detail=f"Unknown rubric: {rubric_name}")
+
+@app.get("/rubrics/")
+async def list_rubrics():
+    """List the available rubrics"""
+    return [rubric.to_dict() for rubric in rubric_registry.all()]
+
+@app.post("/upload-pdf/", status_code=202)
+async def upload_pdf(file: UploadFile = File(...), rubric: str = DEFAULT_RUBRIC, force: bool = False):
+    """Queue an uploaded PDF for grading; poll /jobs/{job_id} for the result"""
+    require_rubric(rubric)
+    filename = os.path.basename(file.filename or "upload.pdf")
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File is larger than the {MAX_UPLOAD_BYTES} byte limit")
+    # Streamed in chunks into a content-addressed file; identical uploads share one copy
+    try:
+        file_path = await run_in_threadpool(spool_file, file.file)
+    except SpoolTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    try:
+        job = job_queue.submit(
+            grade_pdf,
+            (file_path, filename),
+            {"rubric_name": rubric, "force": force},
+            # Same bytes under another name, rubric or force flag is a different grading
+            key=f"{file_path}:{filename}:{rubric}:{force}",
+            resource=file_path,
+        )
+    except QueueFull as e:
+        # Leave the file in the spool; /grade-all/ will pick it up once the queue drains
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+    return {"job_id": job.id, "status": job.status, "filename": filename}
+
+@app.post("/bulk-upload/", status_code=202)
+async def bulk_upload(files: list[UploadFile] = File(...), rubric: str = DEFAULT_RUBRIC, force: bool = False):
+    """Queue a batch of PDFs (and/or ZIP archives of PDFs) for grading.
+
+    Follow progress on /bulk/{batch_id}/events and download the grades from
+    /bulk/{batch_id}/results.csv once the batch is done.
+    """
+    require_rubric(rubric)
+    # The multipart parser has already streamed each part to a temporary file; spool the PDFs from there
+    try:
+        items = await run_in_threadpool(spool_uploads, [(file.filename, file.file) for file in files])
+    except BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not any(item.path for item in items):
+        raise HTTPException(status_code=400, detail="No PDF files found in the upload")
+
+    batch = bulk_batches.start(items, grade_pdf, rubric, force=force)
+    return {
+        "batch_id": batch.id,
+        "counts": batch.counts(),
+        "files": [item.to_dict() for item in items],
+        "events": f"/bulk/{batch.id}/events",
+        "csv": f"/bulk/{batch.id}/results.csv",
+    }
+
+def require_batch(batch_id):
+    batch = bulk_batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+@app.get("/bulk/{batch_id}")
+async def get_bulk_batch(batch_id: str):
+    """Return the status of every file in a bulk upload"""
+    return require_batch(batch_id).to_dict()
+
+@app.get("/bulk/{batch_id}/events")
+async def bulk_batch_events(batch_id: str, request: Request):
+    """Server-Sent Events: a `file` event whenever a file is queued or graded, then `done`.
+
+    Every event so far is replayed on connect, or those after Last-Event-ID
+    when the browser reconnects.
+    """
+    batch = require_batch(batch_id)
+    try:
+        last_seen = int(request.headers.get("last-event-id", "-1"))
+    except ValueError:
+        last_seen = -1
+
+    async def stream():
+        seq = last_seen
+        while True:
+            events = await batch.events_after(seq)
+            if not events:
+                # Comment line; keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            for seq, event, data in events:
+                yield format_event(seq, event, data)
+                if event == "done":
+                    return
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/bulk/{batch_id}/results.csv")
+async def bulk_batch_csv(batch_id: str):
+    """Grades for every file in a finished bulk upload, one row per file"""
+    batch = require_batch(batch_id)
+    if not batch.finished:
+        raise HTTPException(status_code=409, detail="Batch is still being graded")
+    return Response(
+        batch.to_csv(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="grades-{batch.id[:8]}.csv"'},
+    )
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Return the status of a grading job, and its result once finished"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/llm/metrics")
+async def llm_metrics():
+    """Model client counters: in-flight calls, retries, throttling and circuit state"""
+    return dict(llm.metrics(), queue_paused_for=round(job_queue.paused_for(), 1))
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: per-stage latencies, queue depths, cache and model counters"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/results/")
-async def get_results():
-    results = read_all_results()
-    return results
+async def get_results(
+    request: Request,
+    course: str | None = None,
+    limit: int | None = Query(None, ge=1, le=MAX_RESULTS_PAGE),
+    cursor: int | None = Query(None, ge=0),
+    since: str | None = None,
+):
+    """Return grading results newer than `cursor`, optionally filtered by course and timestamp.
+
+    The id to pass as `cursor` on the next poll is returned in X-Next-Cursor,
+    so a dashboard only downloads results written since its previous poll.
+    """
+    await run_in_threadpool(results_index.refresh)
+    etag = results_index.etag(course, limit, cursor, since)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    results, next_cursor, has_more = await run_in_threadpool(
+        results_index.page, course=course, since=since, cursor=cursor, limit=limit
+    )
+    headers = {
+        "ETag": etag,
+        "X-Next-Cursor": str(next_cursor),
+        "X-Has-More": "true" if has_more else "false",
+    }
+    return JSONResponse(results, headers=headers)
+
+@app.get("/stats/")
+async def get_stats(course: str | None = None, rubric: str | None = None, student: str | None = None):
+    """Grade statistics per course and rubric: count, mean, variance and a histogram, overall and per criterion.
+
+    Kept up to date as each result is written, so this never scans the
+    stored results. Pass `student` (email, or name for uploads) for one
+    student's figures instead of the class's.
+    """
+    return await run_in_threadpool(store.stats, course=course, rubric=rubric, student=student)
+
+def list_pending_pdfs():
+    if not os.path.isdir(INCOMING_DIR):
+        return []
+    return sorted(
+        os.path.join(INCOMING_DIR, name)
+        for name in os.listdir(INCOMING_DIR)
+        if name.lower().endswith(".pdf")
+    )
 
 @app.post("/grade-all/")
-async def grade_all():
-    """Endpoint to process all pending submissions"""
-    # This would typically process files in a queue
-    # For now, return a success message
-    return {"message": "All submissions processed", "processed_count": 0}
-
-# Start the email worker in a separate thread
-@app.on_event("startup")
-async def startup_event():
-    thread = threading.Thread(target=check_inbox_periodically)
-    thread.daemon = True
-    thread.start()
\ No newline at end of file
+async def grade_all(rubric: str = DEFAULT_RUBRIC, force: bool = False):
+    """Queue every pending PDF in the incoming directory for grading"""
+    require_rubric(rubric)
+    job_ids = []
+    deferred_count = 0
+    for file_path in await run_in_threadpool(list_pending_pdfs):
+        if job_queue.is_busy(file_path):
+            continue
+        try:
+            job = job_queue.submit(
+                grade_pdf,
+                (file_path, os.path.basename(file_path)),
+                {"rubric_name": rubric, "force": force},
+                key=f"{file_path}:{rubric}:{force}",
+                resource=file_path,
+            )
+        except QueueFull:
+            # Backpressure: whatever doesn't fit stays pending for the next call
+            deferred_count += 1
+            continue
+        job_ids.append(job.id)
+
+    return {
+        "message": f"Queued {len(job_ids)} submissions for grading",
+        "processed_count": len(job_ids),
+        "job_ids": job_ids,
+        "deferred_count": deferred_count,
+        "queue_depth": job_queue.depth(),
+    }
@@ -0,0 +1,60 @@
+"""MinHash signatures of submission text.
+
+Kept free of app imports so the PDF parser processes can compute
+signatures without loading the rest of the grader.
+"""
+import hashlib
+import random
+import re
+from array import array
+
+# Changing any of these invalidates stored signatures
+SHINGLE_WORDS = 5
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 32
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WORD = re.compile(r"\w+")
+
+# Fixed seed: signatures must come out the same in every process and after restarts
+_rng = random.Random(1)
+PERMUTATIONS = [
+    (_rng.randrange(1, MERSENNE_PRIME), _rng.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERMUTATIONS)
+]
+
+
+def shingles(text):
+    """Hashes of every run of SHINGLE_WORDS consecutive words, ignoring case and punctuation."""
+    words = WORD.findall(text.lower())
+    if not words:
+        return set()
+    size = min(SHINGLE_WORDS, len(words))
+    return {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i:i + size]).encode(), digest_size=4).digest(), "big")
+        for i in range(len(words) - size + 1)
+    }
+
+
+def minhash(text):
+    """MinHash signature of the text's shingles, or None if it has no words."""
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    return array("Q", (
+        min((a * h + b) % MERSENNE_PRIME for h in hashes) & MAX_HASH
+        for a, b in PERMUTATIONS
+    ))
+
+
+def estimate_similarity(left, right):
+    """Estimated Jaccard similarity of the two texts' shingle sets."""
+    return sum(1 for x, y in zip(left, right) if x == y) / len(left)
+
+
+def band_buckets(signature):
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(rows.tobytes(), digest_size=8).digest()
+        # SQLite integers are signed 64-bit
+        yield band, int.from_bytes(digest, "big", signed=True)
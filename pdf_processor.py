@@ -1,21 +1,357 @@
+import hashlib
+import importlib.util
+import logging
+import mmap
+import multiprocessing
 import os
 import re
-from PyPDF2 import PdfReader
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from grading_cache import GradingCache
+from metrics import STAGE_SECONDS, registry, span
+
+logger = logging.getLogger(__name__)
 
 INCOMING_DIR = "incoming_pdfs"
+# Email attachments are spooled separately: /grade-all/ drains INCOMING_DIR and must not
+# grade, a second time and without the sender, attachments the email worker still owns
+EMAIL_SPOOL_DIR = "incoming_email"
+# PDFs are moved here once graded so /grade-all/ only picks up pending ones
+GRADED_DIR = "graded_pdfs"
+# PDFs that can't be graded are moved here instead, so /grade-all/ doesn't retry them forever
+FAILED_DIR = "failed_pdfs"
+
+# Parser processes shared by all extractions
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 2)))
+# Pages handed to a parser process per task
+PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# Larger files are rejected before parsing; pages past the cap are ignored
+MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES", str(50 * 1024 * 1024)))
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "300"))
+# Seconds of parsing allowed per document before its workers are killed
+PDF_EXTRACT_TIMEOUT = float(os.getenv("PDF_EXTRACT_TIMEOUT", "60"))
+
+# Pages with less text than this but with images are treated as scans and OCRed.
+# OCR needs the optional pytesseract and pdf2image packages plus the tesseract
+# and poppler binaries; without them scanned pages are left empty.
+OCR_ENABLED = os.getenv("OCR_ENABLED", "true").lower() != "false"
+OCR_MIN_PAGE_CHARS = int(os.getenv("OCR_MIN_PAGE_CHARS", "20"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(max((os.cpu_count() or 2) // 2, 1))))
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+# Seconds allowed for rendering and for recognising a single page
+OCR_PAGE_TIMEOUT = float(os.getenv("OCR_PAGE_TIMEOUT", "60"))
+OCR_CACHE_DB = os.getenv("OCR_CACHE_DB", "ocr_cache.db")
+# Documents with fewer letters and digits than this are rejected instead of graded
+MIN_USABLE_CHARS = int(os.getenv("MIN_USABLE_CHARS", "100"))
+
+
+PAGES_EXTRACTED = registry.counter("grader_pdf_pages_extracted_total", "PDF pages whose text was extracted")
+PAGES_OCRED = registry.counter("grader_pdf_pages_ocr_total", "Scanned PDF pages run through OCR")
+OCR_CACHE_HITS = registry.counter("grader_ocr_cache_hits_total", "Scanned pages whose OCR text came from the cache")
+DOCUMENTS_REJECTED = registry.counter("grader_pdf_rejected_total", "PDFs rejected for having no usable text")
+
+
+class PDFTooLarge(Exception):
+    pass
+
+
+class PDFTimeout(Exception):
+    pass
+
+
+class NoUsableText(Exception):
+    """Raised for PDFs with no text layer that OCR couldn't read either; they are never sent to the model."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_ocr_pool = None
+# Same LRU cache as the gradings, keyed by page hash, so a rescanned or resent page is only OCRed once
+ocr_cache = GradingCache(path=OCR_CACHE_DB)
+_ocr_available = None
+
+
+def _extract_page_range(file_path, start, stop):
+    """Parse pages [start, stop) in a worker process.
+
+    Returns the document's page count, the page texts, how long each page
+    took and {page index: page hash} for pages that look scanned.
+    """
+    # Imported here so only the parser processes pay for loading PyPDF2
+    from PyPDF2 import PdfReader
+
+    # PyPDF2 seeks around the file constantly; an mmap serves those reads without syscalls or a bytes copy
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        reader = PdfReader(data)
+        page_count = len(reader.pages)
+        stop = min(stop, page_count)
+        texts = []
+        seconds = []
+        scanned = {}
+        for i in range(start, stop):
+            page_start = time.perf_counter()
+            page = reader.pages[i]
+            text = page.extract_text() or ""
+            texts.append(text)
+            # Triage: only pages without a usable text layer that carry images go to OCR
+            if OCR_ENABLED and len(text.strip()) < OCR_MIN_PAGE_CHARS:
+                try:
+                    page_hash = _page_image_hash(page)
+                except Exception as e:
+                    # A malformed resource dictionary shouldn't cost the whole document; treat it as imageless
+                    logger.warning("Could not inspect images on page %d of %s: %s", i + 1, file_path, e)
+                    page_hash = None
+                if page_hash is not None:
+                    scanned[i] = page_hash
+            seconds.append(time.perf_counter() - page_start)
+        return page_count, texts, seconds, scanned
+
+
+def _resolve(value):
+    # PyPDF2's .get() returns indirect references unresolved
+    return value.get_object() if value is not None else None
+
+
+def _page_images(resources, depth=0):
+    """Yield the image XObjects on a page, including those inside form XObjects."""
+    resources = _resolve(resources)
+    xobjects = _resolve(resources.get("/XObject")) if resources else None
+    for name in xobjects or {}:
+        xobject = _resolve(xobjects[name])
+        if xobject.get("/Subtype") == "/Image":
+            yield xobject
+        elif xobject.get("/Subtype") == "/Form" and depth < 3:
+            yield from _page_images(xobject.get("/Resources"), depth + 1)
+
+
+def _page_image_hash(page):
+    """Hash of a page's images and the OCR settings, or None if it has no images."""
+    digest = hashlib.sha256(f"{OCR_DPI}\x00{OCR_LANG}\x00".encode())
+    found = False
+    for image in _page_images(page.get("/Resources")):
+        digest.update(image.get_data())
+        found = True
+    return digest.hexdigest() if found else None
+
+
+def _ocr_page(file_path, page_index):
+    """Render one page and OCR it in an OCR worker process; returns (text, seconds)."""
+    # Optional dependencies, only ever imported in the OCR processes
+    import pytesseract
+    from pdf2image import convert_from_path
+
+    start = time.perf_counter()
+    images = convert_from_path(
+        file_path, dpi=OCR_DPI, first_page=page_index + 1, last_page=page_index + 1, timeout=OCR_PAGE_TIMEOUT
+    )
+    text = "\n".join(pytesseract.image_to_string(image, lang=OCR_LANG, timeout=OCR_PAGE_TIMEOUT) for image in images)
+    return text, time.perf_counter() - start
+
+
+def _record_pages(seconds):
+    # Timed in the worker process; recorded here, where the metrics live
+    for elapsed in seconds:
+        STAGE_SECONDS.observe(elapsed, stage="extract_page")
+    PAGES_EXTRACTED.inc(len(seconds))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forkserver avoids forking the web process with its threads and sockets
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def _get_ocr_pool():
+    """Separate pool, so slow OCR doesn't hold up text-layer pages of other documents."""
+    global _ocr_pool
+    with _pool_lock:
+        if _ocr_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _ocr_pool
+
+
+def ocr_available():
+    global _ocr_available
+    if _ocr_available is None:
+        _ocr_available = all(importlib.util.find_spec(name) for name in ("pytesseract", "pdf2image"))
+        if not _ocr_available:
+            logger.warning("pytesseract or pdf2image is not installed; scanned pages can't be OCRed.")
+    return _ocr_available
+
+
+def _start_ocr(file_path, scanned):
+    """Look up each scanned page in the OCR cache and queue OCR for the rest.
+
+    Returns {page index: cached text or (future, page hash)}.
+    """
+    if not scanned or not ocr_available():
+        return {}
+    pending = {}
+    for index, page_hash in scanned.items():
+        cached = ocr_cache.get(page_hash)
+        if cached is not None:
+            OCR_CACHE_HITS.inc()
+            pending[index] = cached
+        else:
+            pending[index] = (_get_ocr_pool().submit(_ocr_page, file_path, index), page_hash)
+    return pending
+
+
+def _finish_ocr(file_path, index, pending):
+    """OCR text for a scanned page, or None if OCR failed."""
+    if isinstance(pending, str):
+        return pending
+    future, page_hash = pending
+    try:
+        # Rendering and recognition each have their own timeout inside the worker
+        text, seconds = future.result(timeout=2 * OCR_PAGE_TIMEOUT + 5)
+    except Exception as e:
+        logger.warning("OCR failed for page %d of %s: %s", index + 1, file_path, e)
+        return None
+    STAGE_SECONDS.observe(seconds, stage="ocr_page")
+    PAGES_OCRED.inc()
+    ocr_cache.put(page_hash, text)
+    return text
+
+
+def _kill_pool(pool):
+    """Terminate a pool whose worker is stuck on a pathological PDF."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    # ProcessPoolExecutor has no public way to stop a running task, so kill the processes
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(file_path, start, stop):
+    pool = _get_pool()
+    return pool, pool.submit(_extract_page_range, file_path, start, stop)
+
+
+def _wait(task, file_path, start, stop, deadline):
+    """Wait for a page-range task, resubmitting once if another document's timeout killed the pool.
+
+    `deadline` is a one-item list holding the document's deadline; it is only
+    set once one of its tasks starts running, so time spent queued behind
+    other documents does not count.
+    """
+    pool, future = task
+    retried = False
+    while True:
+        if deadline[0] is None and future.running():
+            deadline[0] = time.monotonic() + PDF_EXTRACT_TIMEOUT
+        wait_for = 0.5 if deadline[0] is None else max(deadline[0] - time.monotonic(), 0)
+        try:
+            return future.result(timeout=wait_for)
+        except TimeoutError:
+            if deadline[0] is not None and time.monotonic() >= deadline[0]:
+                _kill_pool(pool)
+                raise PDFTimeout(f"Extracting {file_path} took longer than {PDF_EXTRACT_TIMEOUT}s")
+        except BrokenProcessPool:
+            if retried:
+                raise
+            retried = True
+            pool, future = _submit(file_path, start, stop)
+
+
+def run_in_pool(func, *args):
+    """Run other CPU-bound work on the parser processes, off the caller's GIL.
+
+    `func` must be importable by the workers, from a module that doesn't pull
+    in the web app. Resubmits once if a timed-out document killed the pool.
+    """
+    for attempt in range(2):
+        try:
+            return _get_pool().submit(func, *args).result()
+        except BrokenProcessPool:
+            if attempt:
+                raise
+
+
+def iter_pdf_pages(file_path):
+    """Yield the text of each page in order, as soon as it has been parsed.
+
+    Pages are parsed in batches of PAGES_PER_TASK across the process pool, so
+    the first pages of a long document are available before the rest are done.
+    """
+    size = os.path.getsize(file_path)
+    if size > MAX_PDF_BYTES:
+        raise PDFTooLarge(f"{file_path} is {size} bytes; the limit is {MAX_PDF_BYTES}")
+
+    deadline = [None]
+    # The first batch also tells us how many pages there are
+    first = _submit(file_path, 0, PAGES_PER_TASK)
+    page_count, texts, seconds, scanned = _wait(first, file_path, 0, PAGES_PER_TASK, deadline)
+    _record_pages(seconds)
+    if page_count > MAX_PDF_PAGES:
+        logger.warning("%s has %d pages; only the first %d will be read.", file_path, page_count, MAX_PDF_PAGES)
+        page_count = MAX_PDF_PAGES
+
+    ranges = [
+        (start, min(start + PAGES_PER_TASK, page_count))
+        for start in range(PAGES_PER_TASK, page_count, PAGES_PER_TASK)
+    ]
+    tasks = [_submit(file_path, start, stop) for start, stop in ranges]
+    ocr = {}
+    try:
+        ocr = _start_ocr(file_path, {i: h for i, h in scanned.items() if i < page_count})
+        yield from _with_ocr(file_path, 0, texts[:page_count], ocr)
+        for task, (start, stop) in zip(tasks, ranges):
+            _, texts, seconds, scanned = _wait(task, file_path, start, stop, deadline)
+            _record_pages(seconds)
+            ocr = _start_ocr(file_path, scanned)
+            yield from _with_ocr(file_path, start, texts, ocr)
+    finally:
+        # Stop queued work if the caller gave up early or extraction failed
+        for _, future in tasks:
+            future.cancel()
+        for pending in ocr.values():
+            if not isinstance(pending, str):
+                pending[0].cancel()
+
+
+def _with_ocr(file_path, start, texts, ocr):
+    """Yield page texts, swapping in OCR text for the scanned pages of this batch."""
+    for index, text in enumerate(texts, start):
+        if index in ocr:
+            text = _finish_ocr(file_path, index, ocr[index]) or text
+        yield text
+
 
 def extract_text_from_pdf(file_path):
-    print(f"Attempting to extract text from PDF: {file_path}")
+    logger.debug("Extracting text from PDF %s", file_path)
     try:
-        reader = PdfReader(file_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        print(f"Successfully extracted text from {file_path}. Length: {len(text)}")
-        return text
+        with span("extract"):
+            # join once instead of growing a string page by page; form feeds mark
+            # page breaks so the preprocessor can find running headers and footers
+            text = "\f".join(iter_pdf_pages(file_path))
     except Exception as e:
-        print(f"Error reading PDF {file_path}: {e}")
-        return ""
+        # Timeouts, oversized and corrupt files keep their own error, rather than
+        # looking like a PDF with no text
+        logger.error("Error reading PDF %s: %s", file_path, e)
+        raise
+    logger.info("Extracted text from %s. Length: %d", file_path, len(text))
+    return text
+
+
+def extract_texts(file_paths):
+    """Extract several PDFs concurrently; returns their texts in the same order."""
+    if not file_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(file_paths), PDF_WORKERS)) as executor:
+        return list(executor.map(extract_text_from_pdf, file_paths))
 
 def extract_student_data(text):
     name_match = re.search(r"(?:Name|Student):\s*(.+)", text, re.IGNORECASE)
@@ -28,16 +364,50 @@ def extract_student_data(text):
 
     return student_name, course_name, assignment_name
 
-def process_single_pdf(file_path):
-    print(f"Processing single PDF: {file_path}")
-    # Ensure the directory exists (create if not)
-    if not os.path.exists(INCOMING_DIR):
-        os.makedirs(INCOMING_DIR)
+def locate_pdf(file_path):
+    """Path of a spooled PDF, following it if another job already moved that content out of the spool."""
+    if os.path.exists(file_path):
+        return file_path
+    for directory in (GRADED_DIR, FAILED_DIR):
+        moved_path = os.path.join(directory, os.path.basename(file_path))
+        if os.path.exists(moved_path):
+            return moved_path
+    return file_path
 
-    # For now, we'll just process the single uploaded file directly
-    text = extract_text_from_pdf(file_path)
+def has_usable_text(text):
+    return sum(1 for char in text if char.isalnum()) >= MIN_USABLE_CHARS
+
+def process_single_pdf(file_path):
+    """Text of a PDF, raising NoUsableText if it parsed but has next to no text."""
+    logger.debug("Processing single PDF %s", file_path)
+    text = extract_text_from_pdf(locate_pdf(file_path))
+    # Grading an empty or near-empty extraction wastes a model call on a meaningless grade
+    if not has_usable_text(text):
+        DOCUMENTS_REJECTED.inc()
+        raise NoUsableText(
+            "No readable text was found in this PDF. If it is a scan, please send a clearer scan "
+            "or a PDF exported from a word processor."
+        )
     return text
 
+def _move(file_path, directory):
+    os.makedirs(directory, exist_ok=True)
+    new_path = os.path.join(directory, os.path.basename(file_path))
+    try:
+        os.replace(file_path, new_path)
+    except FileNotFoundError:
+        # Same content was already moved by another job
+        pass
+    return new_path
+
+def mark_graded(file_path):
+    """Move a graded PDF out of the incoming directory and return its new path."""
+    return _move(file_path, GRADED_DIR)
+
+def mark_failed(file_path):
+    """Move a PDF that couldn't be graded out of the incoming directory and return its new path."""
+    return _move(file_path, FAILED_DIR)
+
 
 if __name__ == '__main__':
     # Example Usage:
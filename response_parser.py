@@ -0,0 +1,193 @@
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Allowed gap (percentage points) between the model's overall_grade and the criterion total
+OVERALL_GRADE_TOLERANCE = 1.0
+
+CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA = re.compile(r",\s*([}\]])")
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"'})
+SCORE = re.compile(r"(-?\d+(?:\.\d+)?)\s*(%|/\s*(\d+(?:\.\d+)?))?")
+
+
+class ResponseParseError(ValueError):
+    pass
+
+
+def extract_json(raw_text, opener="{"):
+    """Parse the JSON object (or array, with opener="[") in a model response.
+
+    Tolerates what models commonly wrap around or leave inside JSON: code
+    fences, leading/trailing prose, trailing commas and curly quotes.
+    """
+    closer = "}" if opener == "{" else "]"
+    text = raw_text or ""
+    fenced = CODE_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find(opener)
+    end = text.rfind(closer)
+    if start == -1 or end <= start:
+        raise ResponseParseError(f"No JSON {'object' if opener == '{' else 'array'} found in AI response")
+    candidate = text[start:end + 1]
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        pass
+    repaired = TRAILING_COMMA.sub(r"\1", candidate.translate(SMART_QUOTES))
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError as e:
+        raise ResponseParseError(f"Failed to parse AI response as JSON: {e}")
+
+
+def parse_score(value, max_points):
+    """Points awarded from "35", 35, "35/40", "35 / 40 points" or "87.5%" (of max_points)."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = SCORE.search(str(value or ""))
+    if not match:
+        return None
+    points = float(match.group(1))
+    if match.group(2) == "%":
+        return points * max_points / 100.0
+    out_of = match.group(3)
+    if out_of and float(out_of) and float(out_of) != max_points:
+        # Scored on a different scale than the rubric; rescale it
+        return points * max_points / float(out_of)
+    return points
+
+
+def parse_percentage(value):
+    """Overall grade as a percentage from "85%", "85", 85 or a 0-1 fraction."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    else:
+        match = SCORE.search(str(value or ""))
+        if not match:
+            return None
+        number = float(match.group(1))
+        if match.group(3):
+            return number * 100.0 / float(match.group(3)) if float(match.group(3)) else None
+        if match.group(2) == "%":
+            return number
+    return number * 100.0 if 0 < number <= 1 and not float(number).is_integer() else number
+
+
+def _normalize_title(title):
+    return " ".join(str(title or "").lower().replace("&", "and").split())
+
+
+def _format_number(value):
+    return f"{value:g}" if value == int(value) else f"{value:.1f}"
+
+
+def validate_grading(result, rubric):
+    """Check a grading against the rubric and fix what can be fixed locally.
+
+    Returns (grading, problems). The grading has criterion names matched to
+    the rubric's titles, scores normalised to "points/max", unknown criteria
+    dropped and overall_grade recomputed from the criterion total.
+    `problems` maps each field that still needs the model to a reason:
+    "feedback", or "criteria:<title>" for a missing or invalid criterion.
+    """
+    if not isinstance(result, dict):
+        raise ResponseParseError("AI response is not a JSON object")
+    problems = {}
+    student_name = result.get("student_name")
+    grading = {
+        "student_name": student_name if isinstance(student_name, str) and student_name.strip() else "Unknown",
+        "overall_grade": result.get("overall_grade", "N/A"),
+        "feedback": result.get("feedback"),
+        "criteria_scores": [],
+    }
+    if not isinstance(grading["feedback"], str) or not grading["feedback"].strip():
+        problems["feedback"] = "missing overall feedback"
+
+    titles = {_normalize_title(title): title for title in rubric.criteria_schema}
+    given = {}
+    scores = result.get("criteria_scores")
+    for entry in scores if isinstance(scores, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        title = titles.get(_normalize_title(entry.get("criterion")))
+        if title is not None and title not in given:
+            given[title] = entry
+
+    total = 0.0
+    for title, max_points in rubric.criteria_schema.items():
+        entry = given.get(title)
+        if entry is None:
+            problems[f"criteria:{title}"] = "missing"
+            continue
+        points = parse_score(entry.get("score"), max_points)
+        if points is None:
+            problems[f"criteria:{title}"] = f"score {entry.get('score')!r} is not a number"
+            continue
+        if not 0 <= points <= max_points:
+            problems[f"criteria:{title}"] = f"score {_format_number(points)} is outside 0-{max_points}"
+            continue
+        total += points
+        grading["criteria_scores"].append({
+            "criterion": title,
+            "score": f"{_format_number(points)}/{_format_number(max_points)}",
+            "justification": entry.get("justification") or "",
+            "detalle": entry.get("detalle") or "",
+        })
+
+    if not any(key.startswith("criteria:") for key in problems) and rubric.total_points:
+        computed = total * 100.0 / rubric.total_points
+        stated = parse_percentage(grading["overall_grade"])
+        if stated is None or abs(stated - computed) > OVERALL_GRADE_TOLERANCE:
+            if stated is not None:
+                logger.info("overall_grade %r does not match criterion total; using %.0f%%.", grading["overall_grade"], computed)
+            grading["overall_grade"] = f"{round(computed)}%"
+        else:
+            grading["overall_grade"] = f"{round(stated)}%"
+    return grading, problems
+
+
+def merge_repair(grading, repair):
+    """Fold the fields returned by a repair request into a grading."""
+    if not isinstance(repair, dict):
+        return grading
+    merged = dict(grading)
+    if isinstance(repair.get("feedback"), str) and repair["feedback"].strip():
+        merged["feedback"] = repair["feedback"]
+    if isinstance(repair.get("criteria_scores"), list):
+        replaced = {_normalize_title(entry.get("criterion")) for entry in repair["criteria_scores"] if isinstance(entry, dict)}
+        merged["criteria_scores"] = [
+            entry for entry in grading["criteria_scores"] if _normalize_title(entry["criterion"]) not in replaced
+        ] + [entry for entry in repair["criteria_scores"] if isinstance(entry, dict)]
+    return merged
+
+
+def repair_instructions(rubric, problems):
+    """Describe only the fields the model must resend, and the JSON shape to send them in."""
+    lines = []
+    shape = {}
+    criteria = []
+    for field, reason in problems.items():
+        if field == "feedback":
+            lines.append("- feedback: overall comprehensive feedback (was missing)")
+            shape["feedback"] = "[Overall comprehensive feedback]"
+        else:
+            title = field.split(":", 1)[1]
+            max_points = rubric.criteria_schema[title]
+            lines.append(f"- criterion \"{title}\": score between 0 and {max_points} points ({reason})")
+            criteria.append({
+                "criterion": title,
+                "score": f"[Points out of {max_points}]",
+                "justification": "[Brief justification based on the rubric and submission]",
+                "detalle": "[Where points were lost, if applicable]",
+            })
+    if criteria:
+        shape["criteria_scores"] = criteria
+    return "\n".join(lines), json.dumps(shape, indent=4)
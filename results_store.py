@@ -0,0 +1,497 @@
+import bisect
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from response_parser import SCORE, parse_percentage, parse_score
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DB = os.getenv("RESULTS_DB", "grading_results.db")
+LEGACY_RESULTS_FILE = "grading_results.json"
+# How often (seconds) the background compactor checkpoints the WAL and reclaims free pages
+COMPACT_INTERVAL = int(os.getenv("RESULTS_COMPACT_INTERVAL", "600"))
+# Histogram buckets per aggregate, evenly splitting 0-100%
+STATS_BUCKETS = 10
+# Grade in results written before the overall_grade field was stored
+LEGACY_GRADE = re.compile(r"Grade:\s*([^\n]+)")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    email TEXT,
+    course TEXT,
+    timestamp TEXT,
+    record TEXT NOT NULL,
+    rubric TEXT,
+    grade REAL
+);
+CREATE INDEX IF NOT EXISTS idx_results_name ON results(name);
+CREATE INDEX IF NOT EXISTS idx_results_email ON results(email);
+CREATE INDEX IF NOT EXISTS idx_results_course ON results(course);
+CREATE INDEX IF NOT EXISTS idx_results_timestamp ON results(timestamp);
+CREATE TABLE IF NOT EXISTS result_scores (
+    result_id INTEGER NOT NULL,
+    criterion TEXT NOT NULL,
+    points REAL,
+    max_points REAL,
+    percent REAL
+);
+CREATE INDEX IF NOT EXISTS idx_result_scores_result ON result_scores(result_id);
+CREATE TABLE IF NOT EXISTS aggregates (
+    course TEXT NOT NULL,
+    rubric TEXT NOT NULL,
+    student TEXT NOT NULL,
+    criterion TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    m2 REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    buckets TEXT NOT NULL,
+    PRIMARY KEY (course, rubric, student, criterion)
+);
+"""
+# Bumped whenever existing databases need migrating; see ResultsStore._migrate
+SCHEMA_VERSION = 2
+
+
+def typed_scores(result):
+    """Return (grade, criteria) as numbers for a result.
+
+    `grade` is the overall percentage, or None if it can't be read, and
+    `criteria` a list of (criterion, points, max_points, percent). max_points
+    is None when the score didn't say what it was out of, and points is None
+    for a bare percentage such as "87.5%" with no known maximum.
+    """
+    grade = result.get("grade")
+    if not isinstance(grade, (int, float)) or isinstance(grade, bool):
+        grade = result.get("overall_grade")
+        if grade is None:
+            match = LEGACY_GRADE.search(result.get("grade_output") or "")
+            grade = match.group(1) if match else None
+        grade = parse_percentage(grade)
+    criteria = []
+    for score in result.get("criteria_scores") or []:
+        if not isinstance(score, dict) or not score.get("criterion"):
+            continue
+        # The score text is the source; stored points are only used when it can't be read
+        match = SCORE.search(str(score.get("score") or ""))
+        if match:
+            max_points = float(match.group(3)) if match.group(3) else None
+            if match.group(2) == "%" and max_points is None:
+                points, percent = None, float(match.group(1))
+            else:
+                points = parse_score(score.get("score"), max_points or 0)
+                percent = _percent(points, max_points)
+        else:
+            points, max_points = score.get("points"), score.get("max_points")
+            percent = score.get("percent")
+            if percent is None and points is not None:
+                percent = _percent(points, max_points)
+        if points is not None or percent is not None:
+            criteria.append((
+                str(score["criterion"]),
+                None if points is None else float(points),
+                max_points,
+                None if percent is None else float(percent),
+            ))
+    return grade, criteria
+
+
+def with_typed_scores(result):
+    """Copy of `result` with numeric `grade` and per-criterion `points`/`max_points`/`percent` fields."""
+    grade, criteria = typed_scores(result)
+    typed = dict(result, grade=grade)
+    numbers = {criterion: (points, max_points, percent) for criterion, points, max_points, percent in criteria}
+    if result.get("criteria_scores"):
+        typed["criteria_scores"] = [
+            dict(score, **dict(zip(("points", "max_points", "percent"), numbers[score["criterion"]])))
+            if isinstance(score, dict) and score.get("criterion") in numbers else score
+            for score in result["criteria_scores"]
+        ]
+    return typed
+
+
+def _percent(points, max_points):
+    if max_points:
+        return points * 100.0 / max_points
+    return None
+
+
+def _bucket_labels():
+    width = 100 / STATS_BUCKETS
+    return [f"{i * width:g}-{(i + 1) * width:g}" for i in range(STATS_BUCKETS)]
+
+
+class ResultsStore:
+    """Append-only grading results store backed by SQLite in WAL mode.
+
+    Each result is a single INSERT, so the cost of a write does not grow with
+    the number of stored results. SQLite serialises writers across threads and
+    processes, so the upload handler and the email worker can't drop each
+    other's writes the way the old read-modify-write JSON file could.
+    """
+
+    def __init__(self, path=RESULTS_DB):
+        self.path = path
+        self._local = threading.local()
+        self._compactor = None
+        self._compactor_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._migrate(conn)
+            self._import_legacy_file(conn)
+        return conn
+
+    def _migrate(self, conn):
+        """Bring a database created by an older version up to SCHEMA_VERSION."""
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated while we waited for the lock
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                conn.execute("COMMIT")
+                return
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+            for column, kind in (("rubric", "TEXT"), ("grade", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE results ADD COLUMN {column} {kind}")
+            if "percent" not in {row[1] for row in conn.execute("PRAGMA table_info(result_scores)")}:
+                conn.execute("ALTER TABLE result_scores ADD COLUMN percent REAL")
+            # Type the results written so far and seed the running aggregates from them
+            conn.execute("DELETE FROM result_scores")
+            conn.execute("DELETE FROM aggregates")
+            rows = conn.execute("SELECT id, record FROM results ORDER BY id").fetchall()
+            for result_id, record in rows:
+                result = with_typed_scores(json.loads(record))
+                conn.execute("UPDATE results SET record = ? WHERE id = ?", (json.dumps(result), result_id))
+                self._index_scores(conn, result_id, result)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if rows:
+            logger.info("Computed typed scores and aggregates for %d existing results.", len(rows))
+
+    def _import_legacy_file(self, conn):
+        """One-off migration of the old grading_results.json into the store."""
+        if not os.path.exists(LEGACY_RESULTS_FILE):
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated the file while we waited for the lock
+            if not os.path.exists(LEGACY_RESULTS_FILE):
+                conn.execute("COMMIT")
+                return
+            try:
+                with open(LEGACY_RESULTS_FILE, "r") as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error("Could not import legacy results file %s: %s", LEGACY_RESULTS_FILE, e)
+                data = []
+            for result in data:
+                if isinstance(result, dict):
+                    self._insert(conn, result)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        os.replace(LEGACY_RESULTS_FILE, LEGACY_RESULTS_FILE + ".migrated")
+        logger.info("Imported %d results from %s.", len(data), LEGACY_RESULTS_FILE)
+
+    def _insert(self, conn, result):
+        """Insert a result with its typed scores; the caller holds a write transaction."""
+        result = with_typed_scores(result)
+        cursor = conn.execute(
+            "INSERT INTO results (name, email, course, timestamp, record) VALUES (?, ?, ?, ?, ?)",
+            (
+                result.get("name"),
+                result.get("email"),
+                result.get("course"),
+                result.get("timestamp"),
+                json.dumps(result),
+            ),
+        )
+        self._index_scores(conn, cursor.lastrowid, result)
+        return cursor.lastrowid
+
+    def _index_scores(self, conn, result_id, result):
+        grade, criteria = typed_scores(result)
+        course = result.get("course") or ""
+        rubric = result.get("rubric") or ""
+        conn.execute("UPDATE results SET rubric = ?, grade = ? WHERE id = ?", (result.get("rubric"), grade, result_id))
+        conn.executemany(
+            "INSERT INTO result_scores (result_id, criterion, points, max_points, percent) VALUES (?, ?, ?, ?, ?)",
+            [(result_id,) + scores for scores in criteria],
+        )
+        # Per class (student "") and per student; criterion "" holds the overall grade
+        values = [("", grade)] + [(criterion, percent) for criterion, _, _, percent in criteria]
+        students = [""]
+        student = result.get("email") or result.get("name")
+        if student:
+            students.append(student)
+        for student in students:
+            for criterion, value in values:
+                if value is not None:
+                    self._update_aggregate(conn, (course, rubric, student, criterion), value)
+
+    @staticmethod
+    def _update_aggregate(conn, key, value):
+        """Fold one value into a running aggregate (Welford's mean and variance) in O(1)."""
+        row = conn.execute(
+            "SELECT count, mean, m2, min, max, buckets FROM aggregates "
+            "WHERE course = ? AND rubric = ? AND student = ? AND criterion = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            count, mean, m2, low, high, buckets = 0, 0.0, 0.0, value, value, [0] * STATS_BUCKETS
+        else:
+            count, mean, m2, low, high, buckets = row[:5] + (json.loads(row[5]),)
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+        bucket = min(max(int(value * STATS_BUCKETS // 100), 0), STATS_BUCKETS - 1)
+        buckets[bucket] += 1
+        conn.execute(
+            "INSERT OR REPLACE INTO aggregates (course, rubric, student, criterion, count, mean, m2, min, max, buckets) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (count, mean, m2, min(low, value), max(high, value), json.dumps(buckets)),
+        )
+
+    def append(self, result):
+        """Append a single result, update the aggregates it belongs to and return its id."""
+        if not result.get("timestamp"):
+            result = dict(result, timestamp=datetime.now(timezone.utc).isoformat())
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result_id = self._insert(conn, result)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.start_compactor()
+        return result_id
+
+    def stats(self, course=None, rubric=None, student=None):
+        """Running aggregates grouped by course and rubric, without scanning any results.
+
+        Class-level figures are returned unless `student` (an email address,
+        or a name for uploads) is given. Scores are percentages of the
+        criterion's maximum; the overall entry is the overall grade.
+        """
+        clauses = ["student = ?"]
+        params = [student or ""]
+        for column, value in (("course", course), ("rubric", rubric)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        rows = self._connect().execute(
+            "SELECT course, rubric, criterion, count, mean, m2, min, max, buckets FROM aggregates WHERE "
+            + " AND ".join(clauses) + " ORDER BY course, rubric, criterion",
+            params,
+        ).fetchall()
+        labels = _bucket_labels()
+        groups = {}
+        for row_course, row_rubric, criterion, count, mean, m2, low, high, buckets in rows:
+            group = groups.setdefault((row_course, row_rubric), {
+                "course": row_course,
+                "rubric": row_rubric,
+                "student": student,
+                "overall": None,
+                "criteria": {},
+            })
+            variance = m2 / count if count else 0.0
+            summary = {
+                "count": count,
+                "mean": round(mean, 2),
+                "variance": round(variance, 2),
+                "stddev": round(math.sqrt(variance), 2),
+                "min": round(low, 2),
+                "max": round(high, 2),
+                "histogram": dict(zip(labels, json.loads(buckets))),
+            }
+            if criterion:
+                group["criteria"][criterion] = summary
+            else:
+                group["overall"] = summary
+        return list(groups.values())
+
+    def query(self, name=None, email=None, course=None, since=None, after_id=None, limit=None):
+        """Return stored results in insertion order, optionally filtered on the indexed fields."""
+        clauses = []
+        params = []
+        for column, value in (("name", name), ("email", email), ("course", course)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if after_id is not None:
+            clauses.append("id > ?")
+            params.append(after_id)
+        sql = "SELECT record FROM results"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = self._connect().execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def all(self):
+        return self.query()
+
+    def ids_after(self, after_id):
+        """Return (id, course) pairs for results written after the given id, oldest first."""
+        return self._connect().execute(
+            "SELECT id, course FROM results WHERE id > ? ORDER BY id", (after_id,)
+        ).fetchall()
+
+    def records(self, ids, since=None):
+        """Return (id, result) pairs for the given ids, oldest first, optionally only those at or after `since`."""
+        if not ids:
+            return []
+        sql = f"SELECT id, record FROM results WHERE id IN ({', '.join('?' for _ in ids)})"
+        params = list(ids)
+        if since is not None:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        rows = self._connect().execute(sql + " ORDER BY id", params).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def latest_id(self):
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM results").fetchone()[0]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def compact(self):
+        """Fold the WAL back into the main database file and release free pages."""
+        conn = self._connect()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA optimize")
+
+    def _compact_periodically(self):
+        while not self._stop.wait(COMPACT_INTERVAL):
+            try:
+                self.compact()
+            except sqlite3.Error as e:
+                logger.error("Error compacting results store: %s", e)
+
+    def start_compactor(self):
+        if self._compactor is not None:
+            return
+        with self._compactor_lock:
+            if self._compactor is None:
+                thread = threading.Thread(target=self._compact_periodically, name="results-compactor")
+                thread.daemon = True
+                thread.start()
+                self._compactor = thread
+
+    def close(self):
+        self._stop.set()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class ResultsIndex:
+    """In-memory index of result ids used to answer /results/ polls.
+
+    Only ids and per-course positions are kept; the records of a page are
+    read from the store by id. The index only reloads when the store's
+    latest id moves, and then only loads the ids written since the last
+    refresh, including those written by other processes (e.g. the email
+    worker).
+    """
+
+    # Ids read from the store per query while filling a page
+    FETCH_BATCH = 500
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._ids = []
+        # course -> positions into _ids, in id order
+        self._by_course = {}
+        self.version = 0
+
+    def refresh(self):
+        """Load any new result ids and return the current version (latest result id)."""
+        if self.store.latest_id() == self.version:
+            return self.version
+        with self._lock:
+            for result_id, course in self.store.ids_after(self.version):
+                self._by_course.setdefault(course, []).append(len(self._ids))
+                self._ids.append(result_id)
+                self.version = result_id
+        return self.version
+
+    def page(self, course=None, since=None, cursor=None, limit=None):
+        """Return (results, next_cursor, has_more) for results newer than the cursor.
+
+        `cursor` is the id of the last result the client has seen and `since`
+        an ISO-8601 timestamp lower bound. Passing the returned `next_cursor` on
+        the next poll yields only results written in between.
+        """
+        with self._lock:
+            version = self.version
+            if course is None:
+                positions = range(len(self._ids))
+            else:
+                positions = self._by_course.get(course, [])
+            start = 0
+            if cursor is not None:
+                # Positions are in id order, so the first unseen one can be bisected
+                start = bisect.bisect_right(positions, cursor, key=self._ids.__getitem__)
+            ids = [self._ids[position] for position in positions[start:]]
+        results = []
+        last_id = None
+        has_more = False
+        for offset in range(0, len(ids), self.FETCH_BATCH):
+            for result_id, record in self.store.records(ids[offset:offset + self.FETCH_BATCH], since=since):
+                if limit is not None and len(results) >= limit:
+                    has_more = True
+                    break
+                results.append(record)
+                last_id = result_id
+            if has_more:
+                break
+        next_cursor = last_id if has_more else max(version, cursor or 0)
+        return results, next_cursor, has_more
+
+    def etag(self, *params):
+        """Weak ETag for a query; changes only when a result is written."""
+        digest = hashlib.sha1(repr((self.version,) + params).encode()).hexdigest()[:16]
+        return f'W/"{self.version}-{digest}"'
+
+
+store = ResultsStore()
+results_index = ResultsIndex(store)
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+RUBRICS_FILE = os.getenv("RUBRICS_FILE", "rubrics.json")
+DEFAULT_RUBRIC = os.getenv("DEFAULT_RUBRIC", "generic")
+
+# "[rubric: essay]" anywhere in an email subject selects that rubric
+SUBJECT_TAG = re.compile(r"\[rubric:\s*([\w.-]+)\s*\]", re.IGNORECASE)
+
+# The rubrics.json that ships with the app; loaded instead when RUBRICS_FILE points
+# elsewhere and is unusable before any good version of it has been read
+SHIPPED_RUBRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rubrics.json")
+
+
+class RubricError(Exception):
+    pass
+
+
+class CompiledRubric:
+    """A validated rubric with its prompt fragment and expected criteria built once."""
+
+    def __init__(self, key, data):
+        self.key = key
+        self.name = data.get("name", key)
+        self.description = data.get("description", "N/A")
+        self.criteria = [
+            {
+                "title": criterion["title"],
+                "points": criterion["points"],
+                "description": criterion.get("description", "N/A"),
+            }
+            for criterion in data["criteria"]
+        ]
+        # criterion title -> maximum points, used to validate model responses
+        self.criteria_schema = {criterion["title"]: criterion["points"] for criterion in self.criteria}
+        self.total_points = sum(self.criteria_schema.values())
+        self.prompt = self._build_prompt()
+
+    def _build_prompt(self):
+        lines = [f"Rubric Name: {self.name}", f"Description: {self.description}", ""]
+        for criterion in self.criteria:
+            lines.append(f"Criteria: {criterion['title']} ({criterion['points']} points)")
+            lines.append(f"Description: {criterion['description']}")
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "name": self.name,
+            "description": self.description,
+            "criteria": self.criteria,
+            "total_points": self.total_points,
+        }
+
+
+def validate_rubric(key, data):
+    if not isinstance(data, dict):
+        raise RubricError(f"Rubric {key} must be an object")
+    criteria = data.get("criteria")
+    if not isinstance(criteria, list) or not criteria:
+        raise RubricError(f"Rubric {key} has no criteria")
+    titles = set()
+    for criterion in criteria:
+        title = criterion.get("title") if isinstance(criterion, dict) else None
+        if not isinstance(title, str) or not title:
+            raise RubricError(f"Rubric {key} has a criterion without a title")
+        if title in titles:
+            raise RubricError(f"Rubric {key} has duplicate criterion {title}")
+        titles.add(title)
+        points = criterion.get("points")
+        if isinstance(points, bool) or not isinstance(points, (int, float)) or points < 0:
+            raise RubricError(f"Rubric {key} criterion {title} has invalid points {points!r}")
+
+
+def load_rubrics(path):
+    """Compile the rubrics in a JSON file, skipping invalid ones.
+
+    Raises RubricError if the file can't be read or holds no valid rubric.
+    """
+    try:
+        with open(path, "r") as f:
+            raw = json.load(f)
+    except OSError as e:
+        raise RubricError(f"Could not read {path}: {e}")
+    except json.JSONDecodeError as e:
+        raise RubricError(f"Could not decode {path}. Check JSON format. {e}")
+    if not isinstance(raw, dict):
+        raise RubricError(f"{path} must hold an object of rubrics keyed by name, not {type(raw).__name__}")
+    rubrics = {}
+    for key, data in raw.items():
+        try:
+            validate_rubric(key, data)
+        except RubricError as e:
+            logger.warning("Skipping invalid rubric: %s", e)
+            continue
+        rubrics[key] = CompiledRubric(key, data)
+    if not rubrics:
+        raise RubricError(f"{path} has no valid rubrics")
+    return rubrics
+
+
+# Stamp of a registry that hasn't looked at its file yet; a missing file's stamp is None
+_UNREAD = object()
+
+
+class RubricRegistry:
+    """Compiled rubrics from RUBRICS_FILE, reloaded only when the file's mtime changes."""
+
+    def __init__(self, path=RUBRICS_FILE):
+        self.path = path
+        self._rubrics = {}
+        self._stamp = _UNREAD
+        self._lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            # Recorded for a broken file too, so it is read (and reported) once per change, not on every lookup
+            self._stamp = stamp
+            try:
+                rubrics = load_rubrics(self.path)
+            except RubricError as e:
+                logger.error("%s", e)
+                if self._rubrics:
+                    logger.warning("Keeping the %d rubrics loaded earlier until %s is fixed.", len(self._rubrics), self.path)
+                else:
+                    self._rubrics = self._shipped_rubrics()
+                return
+            self._rubrics = rubrics
+            logger.info("Loaded %d rubrics from %s.", len(rubrics), self.path)
+
+    def _shipped_rubrics(self):
+        if os.path.abspath(self.path) == SHIPPED_RUBRICS_FILE:
+            return {}
+        try:
+            rubrics = load_rubrics(SHIPPED_RUBRICS_FILE)
+        except RubricError as e:
+            logger.error("%s", e)
+            return {}
+        logger.warning("Using the %d rubrics shipped in %s until %s is fixed.", len(rubrics), SHIPPED_RUBRICS_FILE, self.path)
+        return rubrics
+
+    def get(self, name):
+        """Return the CompiledRubric called `name`, or None if there is no such rubric."""
+        self._reload_if_changed()
+        return self._rubrics.get(name)
+
+    def names(self):
+        self._reload_if_changed()
+        return sorted(self._rubrics)
+
+    def all(self):
+        self._reload_if_changed()
+        return [self._rubrics[name] for name in sorted(self._rubrics)]
+
+    def rubric_for_subject(self, subject):
+        """Rubric named by a "[rubric: name]" tag in an email subject, else the default."""
+        match = SUBJECT_TAG.search(subject or "")
+        if match and self.get(match.group(1)) is not None:
+            return match.group(1)
+        return DEFAULT_RUBRIC
+
+
+rubric_registry = RubricRegistry()
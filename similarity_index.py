@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from batch_grader import grade_prepared
+from metrics import registry, span
+from minhash import band_buckets, estimate_similarity, minhash
+from pdf_processor import run_in_pool
+from results_store import RESULTS_DB
+from text_preprocessor import clean_text, preprocess_submission
+
+logger = logging.getLogger(__name__)
+
+# Kept next to the results store so the two move and back up together
+SIMILARITY_DB = os.getenv("SIMILARITY_DB", os.path.join(os.path.dirname(RESULTS_DB), "similarity_index.db"))
+# Earlier submissions at least this similar are reported with each new one
+SIMILARITY_REPORT_THRESHOLD = float(os.getenv("SIMILARITY_REPORT_THRESHOLD", "0.5"))
+# Above this the result is flagged for a possible shared-work review
+SIMILARITY_FLAG_THRESHOLD = float(os.getenv("SIMILARITY_FLAG_THRESHOLD", "0.8"))
+# With SIMILARITY_REUSE_GRADES=true, a submission this similar to one graded on the same rubric reuses its grade
+SIMILARITY_REUSE_GRADES = os.getenv("SIMILARITY_REUSE_GRADES", "false").lower() == "true"
+SIMILARITY_REUSE_THRESHOLD = float(os.getenv("SIMILARITY_REUSE_THRESHOLD", "0.95"))
+SIMILARITY_MAX_MATCHES = int(os.getenv("SIMILARITY_MAX_MATCHES", "5"))
+# LSH candidates compared exactly per lookup, most band collisions first; bounds the cost
+# when many submissions share boilerplate such as the assignment prompt
+SIMILARITY_MAX_CANDIDATES = int(os.getenv("SIMILARITY_MAX_CANDIDATES", "200"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    label TEXT,
+    submitter TEXT,
+    student_name TEXT,
+    rubric TEXT,
+    signature BLOB NOT NULL,
+    grading TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lsh_buckets (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    signature_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_lsh_buckets ON lsh_buckets(band, bucket);
+"""
+
+SIMILAR_SUBMISSIONS = registry.counter("grader_similar_submissions_total", "Submissions flagged as near-duplicates of earlier ones")
+GRADES_REUSED = registry.counter("grader_grades_reused_total", "Grades reused from a near-identical earlier submission")
+
+
+class SimilarityIndex:
+    """Persistent MinHash/LSH index of graded submission texts.
+
+    A lookup only touches the submissions that share at least one LSH band
+    with the new one, so its cost depends on how many near-duplicates exist,
+    not on how many submissions are stored.
+    """
+
+    def __init__(self, path=SIMILARITY_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            if "submitter" not in {row[1] for row in conn.execute("PRAGMA table_info(signatures)")}:
+                # Older indexes only had the label; their rows never count as anyone's own submission
+                try:
+                    conn.execute("ALTER TABLE signatures ADD COLUMN submitter TEXT")
+                except sqlite3.OperationalError:
+                    # Another process added it first
+                    pass
+            self._local.conn = conn
+        return conn
+
+    def nearest(self, signature, limit=SIMILARITY_MAX_MATCHES, threshold=SIMILARITY_REPORT_THRESHOLD):
+        """Return up to `limit` (None for all) earlier submissions at least `threshold` similar, most similar first."""
+        conn = self._connect()
+        buckets = list(band_buckets(signature))
+        placeholders = ", ".join("(?, ?)" for _ in buckets)
+        rows = conn.execute(
+            # A join rather than "(band, bucket) IN (...)", which SQLite answers with a full table scan
+            f"WITH wanted(band, bucket) AS (VALUES {placeholders}) "
+            "SELECT s.id, s.label, s.submitter, s.student_name, s.rubric, s.signature, s.created_at FROM signatures s JOIN ("
+            "  SELECT l.signature_id, COUNT(*) AS hits FROM wanted w"
+            "  JOIN lsh_buckets l ON l.band = w.band AND l.bucket = w.bucket"
+            "  GROUP BY l.signature_id ORDER BY hits DESC LIMIT ?"
+            ") c ON c.signature_id = s.id",
+            [value for bucket in buckets for value in bucket] + [SIMILARITY_MAX_CANDIDATES],
+        ).fetchall()
+        matches = []
+        for signature_id, label, submitter, student_name, rubric, stored, created_at in rows:
+            similarity = estimate_similarity(signature, array("Q", stored))
+            if similarity >= threshold:
+                matches.append({
+                    "id": signature_id,
+                    "label": label,
+                    "submitter": submitter,
+                    "student_name": student_name,
+                    "rubric": rubric,
+                    "similarity": round(similarity, 3),
+                    "submitted_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(created_at)),
+                })
+        matches.sort(key=lambda match: match["similarity"], reverse=True)
+        return matches[:limit]
+
+    def grading(self, signature_id):
+        row = self._connect().execute("SELECT grading FROM signatures WHERE id = ?", (signature_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def add(self, signature, label, rubric, grading=None, submitter=None):
+        """Index a graded submission and return its id."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                "INSERT INTO signatures (label, submitter, student_name, rubric, signature, grading, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    label,
+                    submitter,
+                    (grading or {}).get("student_name"),
+                    rubric,
+                    signature.tobytes(),
+                    json.dumps(grading) if grading else None,
+                    time.time(),
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO lsh_buckets (band, bucket, signature_id) VALUES (?, ?, ?)",
+                [(band, bucket, cursor.lastrowid) for band, bucket in band_buckets(signature)],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+
+
+def grade_checked(text, rubric_name, label, submitter=None, force=False):
+    """Grade extracted submission text, reporting earlier submissions it closely resembles.
+
+    `label` names the submission in reports (sender address, or filename for
+    uploads). `submitter` is a verified identity such as the sender address;
+    uploads have none, since two students can upload files with the same
+    name. The result gains `similar_submissions` and `similarity_flagged`,
+    which leave out the submitter's own earlier work. When grade reuse is on
+    and the same submitter already sent a nearly identical submission on the
+    same rubric, that grade is returned (with `reused_grade_from`) instead of
+    calling the model; `force` always regrades.
+    """
+    with span("similarity"):
+        # Hashing every shingle of a long submission takes seconds of CPU; keep it off this process
+        signature = run_in_pool(minhash, clean_text(text))
+        matches = similarity_index.nearest(signature, limit=None) if signature is not None else []
+    # A student's own resubmissions are candidates for reuse, never evidence of shared work
+    own = [match for match in matches if submitter is not None and match["submitter"] == submitter]
+    matches = [match for match in matches if match not in own][:SIMILARITY_MAX_MATCHES]
+
+    result = None
+    reusable = [match for match in own if match["rubric"] == rubric_name and match["similarity"] >= SIMILARITY_REUSE_THRESHOLD]
+    if SIMILARITY_REUSE_GRADES and reusable and not force:
+        result = similarity_index.grading(reusable[0]["id"])
+        if result is not None:
+            GRADES_REUSED.inc()
+            logger.info("Reusing the grade of %s's earlier submission (similarity %.2f).", submitter, reusable[0]["similarity"])
+            result = dict(result, reused_grade_from={
+                key: reusable[0][key] for key in ("label", "submitted_at", "similarity")
+            })
+    if result is None:
+        result = grade_prepared(preprocess_submission(text), rubric_name, force=force)
+    if "error" in result:
+        return result
+
+    if signature is not None:
+        similarity_index.add(signature, label, rubric_name, result, submitter=submitter)
+    flagged = bool(matches) and matches[0]["similarity"] >= SIMILARITY_FLAG_THRESHOLD
+    if flagged:
+        SIMILAR_SUBMISSIONS.inc()
+        logger.warning("%s is %.0f%% similar to %s.", label, matches[0]["similarity"] * 100, matches[0]["label"],
+                       extra={"similar_submissions": matches})
+    result["similar_submissions"] = [
+        {key: value for key, value in match.items() if key not in ("id", "submitter")} for match in matches
+    ]
+    result["similarity_flagged"] = flagged
+    return result
+
+
+similarity_index = SimilarityIndex()
+registry.callback("similarity_index_submissions", "Submissions in the near-duplicate index", similarity_index.count)
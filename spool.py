@@ -0,0 +1,143 @@
+import binascii
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from metrics import span
+from pdf_processor import EMAIL_SPOOL_DIR, FAILED_DIR, GRADED_DIR, INCOMING_DIR
+
+logger = logging.getLogger(__name__)
+
+# Spooled submissions are named by content hash, so identical files share one copy
+SPOOL_DIR = INCOMING_DIR
+SPOOL_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# Graded and failed PDFs older than this (seconds) are deleted by the cleanup thread
+SPOOL_RETENTION = int(os.getenv("SPOOL_RETENTION", str(7 * 24 * 3600)))
+SPOOL_CLEANUP_INTERVAL = int(os.getenv("SPOOL_CLEANUP_INTERVAL", "3600"))
+# Partial writes left behind by a crash are removed after this long
+STALE_TEMP_AGE = 3600
+
+
+class SpoolTooLarge(Exception):
+    pass
+
+
+def spool_chunks(chunks, max_bytes=MAX_UPLOAD_BYTES, directory=SPOOL_DIR):
+    """Write an iterable of byte chunks into the spool and return the content-addressed path.
+
+    The data is hashed while it is written, and the write is abandoned as soon
+    as it exceeds `max_bytes`. If a file with the same content is already
+    spooled, the new copy is discarded and the existing path is returned.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".spool-", suffix=".part")
+    try:
+        with span("spool"), os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise SpoolTooLarge(f"File is larger than the {max_bytes} byte limit")
+                digest.update(chunk)
+                f.write(chunk)
+        path = os.path.join(directory, f"{digest.hexdigest()}.pdf")
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            # Refresh the mtime so retention counts from the latest submission
+            os.utime(path)
+        else:
+            os.replace(tmp_path, path)
+        return path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def iter_file(fileobj, chunk_size=SPOOL_CHUNK_SIZE):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def spool_file(fileobj, max_bytes=MAX_UPLOAD_BYTES):
+    """Spool a readable binary file object (e.g. an UploadFile's .file) in chunks."""
+    return spool_chunks(iter_file(fileobj), max_bytes)
+
+
+def iter_base64(payload, chunk_size=SPOOL_CHUNK_SIZE):
+    """Decode base64 MIME content a chunk at a time instead of into one big bytes object."""
+    view = memoryview(payload)
+    leftover = b""
+    for start in range(0, len(view), chunk_size):
+        piece = leftover + bytes(view[start:start + chunk_size]).translate(None, b" \t\r\n")
+        cut = len(piece) - len(piece) % 4
+        leftover = piece[cut:]
+        if cut:
+            yield binascii.a2b_base64(piece[:cut])
+    if leftover:
+        yield binascii.a2b_base64(leftover)
+
+
+def iter_bytes(payload, chunk_size=SPOOL_CHUNK_SIZE):
+    view = memoryview(payload)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def cleanup_spool(retention=SPOOL_RETENTION):
+    """Delete graded and failed PDFs past retention and stale partial writes; returns how many were removed."""
+    now = time.time()
+    removed = 0
+    for directory, max_age, matches in (
+        (GRADED_DIR, retention, lambda name: name.endswith(".pdf")),
+        (FAILED_DIR, retention, lambda name: name.endswith(".pdf")),
+        (SPOOL_DIR, STALE_TEMP_AGE, lambda name: name.startswith(".spool-")),
+        (EMAIL_SPOOL_DIR, STALE_TEMP_AGE, lambda name: name.startswith(".spool-")),
+        # Attachments left behind when a worker died mid-grade; nothing else picks them up
+        (EMAIL_SPOOL_DIR, retention, lambda name: name.endswith(".pdf")),
+    ):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not matches(entry.name):
+                continue
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                # Raced with another cleanup or a grader moving the file
+                continue
+    return removed
+
+
+def _cleanup_periodically():
+    while True:
+        try:
+            removed = cleanup_spool()
+            if removed:
+                logger.info("Spool cleanup removed %d files.", removed)
+        except Exception as e:
+            logger.error("Error cleaning up spool: %s", e)
+        time.sleep(SPOOL_CLEANUP_INTERVAL)
+
+
+_cleanup_thread = None
+_cleanup_lock = threading.Lock()
+
+
+def start_cleanup():
+    global _cleanup_thread
+    with _cleanup_lock:
+        if _cleanup_thread is None:
+            _cleanup_thread = threading.Thread(target=_cleanup_periodically, name="spool-cleanup")
+            _cleanup_thread.daemon = True
+            _cleanup_thread.start()
@@ -0,0 +1,101 @@
+import pytest
+
+import imap_client
+from imap_client import MailboxSession
+
+
+class FakeIMAP:
+    """Answers UID SEARCH from a fixed set of message UIDs, like a real server would."""
+
+    def __init__(self, uids, uidvalidity=1):
+        self.uids = sorted(uids)
+        self.uidvalidity = uidvalidity
+        self.searches = []
+
+    def login(self, user, password):
+        pass
+
+    def select(self, mailbox):
+        pass
+
+    def response(self, code):
+        return code, [str(self.uidvalidity).encode()]
+
+    def logout(self):
+        pass
+
+    def uid(self, command, *args):
+        assert command == "SEARCH"
+        criteria = args[-1]
+        self.searches.append(criteria)
+        if criteria.startswith("UID "):
+            start = int(criteria[4:].split(":")[0])
+            # "N:*" always includes the newest message, even when it is older than N
+            found = [uid for uid in self.uids if uid >= start] or self.uids[-1:]
+        else:
+            found = self.uids
+        return "OK", [" ".join(str(uid) for uid in found).encode()]
+
+
+@pytest.fixture
+def state_file(tmp_path, monkeypatch):
+    path = tmp_path / "email_state.json"
+    monkeypatch.setattr(imap_client, "EMAIL_STATE_FILE", str(path))
+    return path
+
+
+def session_with(server):
+    session = MailboxSession("user", "password")
+    session.mail = server
+    session.uidvalidity = server.uidvalidity
+    session.state.setdefault("uidvalidity", server.uidvalidity)
+    return session
+
+
+def test_first_run_uses_initial_criteria(state_file):
+    server = FakeIMAP([3, 5, 8])
+    session = session_with(server)
+
+    assert session.new_uids("(UNSEEN)") == [3, 5, 8]
+    assert server.searches == ["(UNSEEN)"]
+
+
+def test_progress_survives_a_restart(state_file):
+    server = FakeIMAP([3, 5, 8])
+    session = session_with(server)
+    for uid in session.new_uids("(UNSEEN)")[:2]:
+        session.mark_processed(uid)
+    assert state_file.exists()
+
+    restarted = session_with(server)
+    assert restarted.last_uid == 5
+    assert restarted.new_uids("(UNSEEN)") == [8]
+    assert server.searches[-1] == "UID 6:*"
+
+
+def test_no_new_mail_ignores_the_newest_old_message(state_file):
+    session = session_with(FakeIMAP([3, 5]))
+    session.mark_processed(5)
+
+    assert session.new_uids("(UNSEEN)") == []
+
+
+def test_mark_processed_never_moves_backwards(state_file):
+    session = session_with(FakeIMAP([3, 5]))
+    session.mark_processed(5)
+    session.mark_processed(3)
+
+    assert session_with(FakeIMAP([3, 5])).last_uid == 5
+
+
+def test_uidvalidity_change_starts_over(state_file, monkeypatch):
+    session = session_with(FakeIMAP([3, 5], uidvalidity=1))
+    session.mark_processed(5)
+
+    server = FakeIMAP([1, 2], uidvalidity=2)
+    monkeypatch.setattr(imap_client.imaplib, "IMAP4", lambda host, port: server)
+    restarted = MailboxSession("user", "password", use_ssl=False)
+    restarted.connect()
+
+    assert restarted.last_uid is None
+    assert restarted.new_uids("(UNSEEN)") == [1, 2]
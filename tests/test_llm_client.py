@@ -0,0 +1,152 @@
+import pytest
+
+import llm_client
+from job_queue import RetryLater
+from llm_client import CircuitBreaker, CircuitOpen, LLMClient
+
+
+class ResourceExhausted(Exception):
+    """Named like the Gemini quota error, which is_retryable recognises by name."""
+
+
+class FakeModel:
+    """Plays back a script of responses; exceptions in the script are raised instead."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record backoff sleeps instead of waiting, with the jitter pinned to 1x."""
+    delays = []
+    monkeypatch.setattr(llm_client.time, "sleep", delays.append)
+    monkeypatch.setattr(llm_client.random, "random", lambda: 0.5)
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_BASE", 1.0)
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_MAX", 3.0)
+    return delays
+
+
+def make_client(model, failure_threshold=5, reset_timeout=60, max_attempts=5):
+    breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+    return LLMClient(model, max_attempts=max_attempts, breaker=breaker)
+
+
+def test_retries_with_exponential_backoff(sleeps):
+    model = FakeModel(ResourceExhausted(), ResourceExhausted(), ResourceExhausted(), "ok")
+    client = make_client(model)
+
+    assert client.generate_content("prompt") == "ok"
+    assert model.calls == 4
+    # 1s, 2s, then capped at LLM_BACKOFF_MAX
+    assert sleeps == [1.0, 2.0, 3.0]
+    assert client.retries == 3
+    assert client.breaker.state == "closed"
+
+
+def test_defers_the_job_after_max_attempts(sleeps):
+    client = make_client(FakeModel(*[ResourceExhausted()] * 3), max_attempts=3)
+
+    with pytest.raises(RetryLater) as excinfo:
+        client.generate_content("prompt")
+    assert not isinstance(excinfo.value, CircuitOpen)
+    assert isinstance(excinfo.value.__cause__, ResourceExhausted)
+    assert excinfo.value.retry_after == 3.0
+    assert client.failures == 3
+    assert len(sleeps) == 2
+    assert client.breaker.state == "closed"
+
+
+def test_defaults_defer_with_the_circuit_open(sleeps):
+    # With the default settings the last attempt is also the failure that opens the circuit
+    client = LLMClient(FakeModel(*[ResourceExhausted()] * llm_client.LLM_MAX_ATTEMPTS))
+
+    with pytest.raises(CircuitOpen) as excinfo:
+        client.generate_content("prompt")
+    assert client.breaker.state == "open"
+    assert excinfo.value.retry_after == client.breaker.reset_timeout
+
+
+def test_non_retryable_error_is_raised_at_once(sleeps):
+    model = FakeModel(ValueError("bad request"), "unused")
+    client = make_client(model)
+
+    with pytest.raises(ValueError):
+        client.generate_content("prompt")
+    assert model.calls == 1
+    assert sleeps == []
+    assert client.breaker.failures == 0
+
+
+def test_circuit_opens_after_threshold(sleeps):
+    client = make_client(FakeModel(*[ResourceExhausted()] * 2), failure_threshold=2, max_attempts=2)
+
+    with pytest.raises(CircuitOpen):
+        client.generate_content("prompt")
+    assert client.breaker.state == "open"
+
+    with pytest.raises(CircuitOpen) as excinfo:
+        client.generate_content("prompt")
+    assert 0 < excinfo.value.retry_after <= 60
+
+
+def open_breaker(reset_timeout=0):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_half_open_probe_success_closes_circuit(sleeps):
+    client = LLMClient(FakeModel("ok"), max_attempts=1, breaker=open_breaker())
+
+    assert client.generate_content("prompt") == "ok"
+    assert client.breaker.state == "closed"
+    assert client.breaker.failures == 0
+
+
+def test_half_open_probe_failure_reopens_circuit(sleeps):
+    breaker = open_breaker()
+    client = LLMClient(FakeModel(ResourceExhausted()), max_attempts=1, breaker=breaker)
+
+    with pytest.raises(CircuitOpen):
+        client.generate_content("prompt")
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+
+def test_non_retryable_probe_closes_circuit(sleeps):
+    # The API answered, so it is up again even though this request was bad
+    breaker = open_breaker()
+    model = FakeModel(ValueError("bad request"), "ok")
+    client = LLMClient(model, max_attempts=1, breaker=breaker)
+
+    with pytest.raises(ValueError):
+        client.generate_content("prompt")
+    assert breaker.state == "closed"
+    assert client.generate_content("prompt") == "ok"
+
+
+def test_only_one_probe_while_half_open():
+    breaker = open_breaker()
+
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+
+def test_interrupted_probe_lets_another_through():
+    breaker = open_breaker()
+
+    assert breaker.before_call() is True
+    breaker.release_probe()
+    assert breaker.state == "open"
+    assert breaker.before_call() is True
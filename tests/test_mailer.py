@@ -0,0 +1,116 @@
+import json
+import smtplib
+from email.message import EmailMessage
+
+import pytest
+
+import mailer
+from mailer import Mailer
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP; fails the first `failures` sends with `error`."""
+
+    instances = []
+
+    def __init__(self, host, port, timeout=None):
+        self.sent = []
+        FakeSMTP.instances.append(self)
+
+    def ehlo(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def noop(self):
+        return 250, b"OK"
+
+    def quit(self):
+        pass
+
+    def send_message(self, msg):
+        if FakeSMTP.failures:
+            FakeSMTP.failures -= 1
+            raise FakeSMTP.error
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def smtp(monkeypatch, tmp_path):
+    FakeSMTP.instances = []
+    FakeSMTP.failures = 0
+    FakeSMTP.error = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+    monkeypatch.setattr(mailer.smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(mailer.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(mailer, "DEAD_LETTER_FILE", str(tmp_path / "dead_letters.jsonl"))
+    return FakeSMTP
+
+
+def make_mailer(max_attempts=3):
+    return Mailer("user", "password", host="localhost", port=25, use_ssl=False, max_per_minute=0,
+                  max_attempts=max_attempts)
+
+
+def message(to="student@example.com"):
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Graded: essay"
+    msg.set_content("Grade: 90%")
+    return msg
+
+
+def dead_letters():
+    try:
+        with open(mailer.DEAD_LETTER_FILE) as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def test_retries_transient_errors_on_a_new_connection(smtp):
+    smtp.failures = 2
+    sender = make_mailer()
+
+    sender._deliver(message())
+
+    assert sender.sent == 1
+    assert sender.retries == 2
+    assert len(smtp.instances) == 3
+    assert dead_letters() == []
+
+
+def test_dead_letters_after_max_attempts(smtp):
+    smtp.failures = 3
+    sender = make_mailer(max_attempts=3)
+
+    sender._deliver(message())
+
+    assert sender.sent == 0
+    assert sender.dead_lettered == 1
+    [entry] = dead_letters()
+    assert entry["to"] == "student@example.com"
+    assert entry["subject"] == "Graded: essay"
+    assert "unexpectedly closed" in entry["error"]
+    assert "Grade: 90%" in entry["message"]
+
+
+def test_refused_recipient_is_not_retried(smtp):
+    smtp.failures = 1
+    smtp.error = smtplib.SMTPRecipientsRefused({"nobody@example.com": (550, b"No such user")})
+    sender = make_mailer()
+
+    sender._deliver(message("nobody@example.com"))
+
+    assert sender.retries == 0
+    assert [entry["to"] for entry in dead_letters()] == ["nobody@example.com"]
+
+
+def test_send_delivers_in_the_background(smtp):
+    sender = make_mailer()
+
+    sender.send(message())
+    sender.flush()
+
+    assert sender.sent == 1
+    assert len(smtp.instances[0].sent) == 1
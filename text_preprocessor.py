@@ -0,0 +1,191 @@
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+from llm_client import estimate_tokens
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Submissions estimated above this many tokens are truncated or graded in chunks
+PROMPT_TOKEN_LIMIT = int(os.getenv("PROMPT_TOKEN_LIMIT", "30000"))
+# "truncate" keeps the start and end plus a summary of the middle; "chunk" grades every part and merges
+PROMPT_OVERFLOW_MODE = os.getenv("PROMPT_OVERFLOW_MODE", "truncate")
+PROMPT_MAX_CHUNKS = int(os.getenv("PROMPT_MAX_CHUNKS", "6"))
+CHARS_PER_TOKEN = 4
+# Lines at the top and bottom of each page checked for running headers/footers
+EDGE_LINES = 3
+PAGE_NUMBER = re.compile(r"^\W*(page\s*)?#(\s*(of|/)\s*#)?\W*$")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+class PreparedSubmission:
+    def __init__(self, chunks, original_tokens, mode):
+        self.chunks = chunks
+        self.original_tokens = original_tokens
+        self.prompt_tokens = sum(estimate_tokens(chunk) for chunk in chunks)
+        self.mode = mode
+
+    @property
+    def text(self):
+        return "\n\n".join(self.chunks)
+
+    def report(self):
+        return {
+            "original_tokens": self.original_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "saved_tokens": max(self.original_tokens - self.prompt_tokens, 0),
+            "mode": self.mode,
+            "chunks": len(self.chunks),
+        }
+
+
+def _page_number_key(line):
+    # Digits vary between pages ("Page 3 of 12"), so match page numbers with them masked
+    return re.sub(r"\d+", "#", line.lower())
+
+
+def _page_numbers(lines, edge):
+    """{masked line: number} for the edge lines of a page that look like page numbers."""
+    numbers = {}
+    for i in edge:
+        key = _page_number_key(lines[i])
+        if PAGE_NUMBER.match(key):
+            numbers.setdefault(key, int(re.search(r"\d+", lines[i]).group()))
+    return numbers
+
+
+def normalize_page(page):
+    lines = [" ".join(line.split()) for line in page.splitlines()]
+    out = []
+    for line in lines:
+        if line or (out and out[-1]):
+            out.append(line)
+    return out
+
+
+def strip_running_lines(pages):
+    """Drop headers, footers and page numbers that repeat at the edges of most pages."""
+    edges = []
+    counts = Counter()
+    for lines in pages:
+        content = [i for i, line in enumerate(lines) if line]
+        edge = set(content[:EDGE_LINES] + content[-EDGE_LINES:])
+        edges.append(edge)
+        counts.update({lines[i].lower() for i in edge})
+    threshold = max(3, math.ceil(0.6 * len(pages)))
+    repeated = {key for key, count in counts.items() if count >= threshold}
+    numbers = [_page_numbers(lines, edge) for lines, edge in zip(pages, edges)]
+    stripped = []
+    for p, (lines, edge) in enumerate(zip(pages, edges)):
+        # A lone number at a page edge may be an answer; it's a page number only if it counts up with its neighbours
+        counted = {
+            key for key, number in numbers[p].items()
+            if (p > 0 and numbers[p - 1].get(key) == number - 1)
+            or (p + 1 < len(pages) and numbers[p + 1].get(key) == number + 1)
+        }
+        kept = []
+        for i, line in enumerate(lines):
+            if i in edge and (line.lower() in repeated or _page_number_key(line) in counted):
+                continue
+            kept.append(line)
+        stripped.append(kept)
+    return stripped
+
+
+def clean_text(text):
+    """Normalise whitespace and remove running headers/footers from form-feed separated pages."""
+    pages = [normalize_page(page) for page in text.split("\f")]
+    if len(pages) >= 3:
+        pages = strip_running_lines(pages)
+    return "\n\n".join("\n".join(lines).strip() for lines in pages if any(lines)).strip()
+
+
+def _cut(text, limit, from_end=False):
+    """Cut text to about `limit` characters, preferring a paragraph or sentence boundary."""
+    if len(text) <= limit:
+        return text
+    if from_end:
+        piece = text[-limit:]
+        boundary = max(piece.find("\n\n"), 0)
+        return piece[boundary:].lstrip()
+    piece = text[:limit]
+    boundary = max(piece.rfind("\n\n"), piece.rfind(". ") + 1)
+    return piece[:boundary] if boundary > limit // 2 else piece
+
+
+def summarize_omitted(text, limit):
+    """Extractive summary: the first sentence of each omitted paragraph, up to `limit` characters."""
+    sentences = []
+    used = 0
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        sentence = SENTENCE_END.split(paragraph, 1)[0]
+        if used + len(sentence) > limit:
+            break
+        sentences.append(sentence)
+        used += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def truncate_with_summary(text, token_limit):
+    budget = token_limit * CHARS_PER_TOKEN
+    head = _cut(text, int(budget * 0.65))
+    tail = _cut(text[len(head):], int(budget * 0.25), from_end=True)
+    middle = text[len(head):len(text) - len(tail)]
+    summary = summarize_omitted(middle, int(budget * 0.08))
+    omitted_words = len(middle.split())
+    return (
+        f"{head}\n\n[... {omitted_words} words omitted from the middle of this submission to fit the grading limit. "
+        f"Summary of the omitted part (first sentence of each paragraph): {summary} ...]\n\n{tail}"
+    )
+
+
+def split_into_chunks(text, token_limit):
+    budget = token_limit * CHARS_PER_TOKEN
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > budget:
+            piece = _cut(paragraph, budget)
+            paragraph = paragraph[len(piece):].lstrip()
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(piece)
+        if current and len(current) + len(paragraph) + 2 > budget:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def preprocess_submission(text, token_limit=PROMPT_TOKEN_LIMIT, mode=PROMPT_OVERFLOW_MODE):
+    """Clean extracted PDF text and fit it into the prompt budget."""
+    with span("preprocess"):
+        return _preprocess(text, token_limit, mode)
+
+
+def _preprocess(text, token_limit, mode):
+    original_tokens = estimate_tokens(text)
+    cleaned = clean_text(text)
+    if estimate_tokens(cleaned) <= token_limit:
+        return PreparedSubmission([cleaned], original_tokens, "full")
+    if mode == "chunk":
+        max_chars = token_limit * CHARS_PER_TOKEN * PROMPT_MAX_CHUNKS
+        if len(cleaned) > max_chars:
+            cleaned = truncate_with_summary(cleaned, token_limit * PROMPT_MAX_CHUNKS)
+        chunks = split_into_chunks(cleaned, token_limit)
+        total = len(chunks)
+        chunks = [
+            f"[Part {i} of {total} of a longer submission. Grade only what is shown in this part.]\n\n{chunk}"
+            for i, chunk in enumerate(chunks, 1)
+        ]
+        return PreparedSubmission(chunks, original_tokens, "chunked")
+    return PreparedSubmission([truncate_with_summary(cleaned, token_limit)], original_tokens, "truncated")